@@ -18,6 +18,10 @@ atlas = Atlas('myeloid')
 print(atlas.pcaCoordinates().head())
 """
 import os, pandas, json, numpy, random
+from functools import lru_cache
+from scipy.cluster.hierarchy import linkage, dendrogram
+from scipy.spatial.distance import pdist
+from scipy.stats import zscore
 
 # ----------------------------------------------------------
 # Functions
@@ -42,20 +46,23 @@ def rankTransform(df):
 def hclusteredRows(df):
     """Return index of df after hierarchical clustering the rows.
     So use df = df.loc[hclusteredRows(df)] to change index after hclust.
-    Seem to get "The symmetric non-negative hollow observation matrix looks suspiciously like an uncondensed distance matrix" warning
-    for linkage function, even though squereform is called beforehand. So just ignoring this warning here.
+    Note that linkage takes the condensed distance matrix from pdist directly - passing it through squareform
+    would make linkage treat each row of the square matrix as an observation.
     """
-    from scipy.cluster.hierarchy import linkage, dendrogram, ClusterWarning
-    from scipy.spatial.distance import pdist, squareform
-    from warnings import simplefilter
-    simplefilter("ignore", ClusterWarning)
-
-    #clust = linkage(squareform(pdist(df.values, metric='euclidean')), method='complete')
-    sf = squareform(pdist(df.values, metric='euclidean'))
-    clust = linkage(sf, method='complete')
+    clust = linkage(pdist(df.values, metric='euclidean'), method='complete')
     dendro = dendrogram(clust, no_plot=True)
     return df.index[dendro['leaves']]
 
+@lru_cache(maxsize=16)
+def _geneInfo(atlasFilePath):
+    """Return genes.tsv under atlasFilePath as a data frame. Cached, since genes.tsv doesn't change within an atlas
+    version - use the real path (not the symlink) as atlasFilePath so that a new version of the atlas gets its own entry.
+    The same data frame is returned on each call, so use Atlas.geneInfo() which returns a copy.
+    """
+    df = pandas.read_csv(os.path.join(atlasFilePath, "genes.tsv"), sep="\t", index_col=0)
+    df.index.name = 'ensembl'
+    return df
+
 def atlasTypes():
     """Return a dictionary of available atlas types and versions.
         {'dc': {'versions': ['1.3', '1.2', '1.1'], 'current_version': '1.3', 'release_notes': 'Updated xxx...'}, ...}
@@ -112,12 +119,34 @@ class Atlas(object):
         filename = "expression.filtered.tsv" if filtered else "expression.tsv"
         return os.path.join(self.atlasFilePath, filename)
 
-    def expressionMatrix(self, filtered=False):
+    def expressionMatrix(self, filtered=False, geneIds=None, sampleIds=None):
         """Return a pandas DataFrame of expression matrix after reading from file.
         If filtered=False, this is the "full" expression matrix that includes all genes. 
         The expression values are from rank normalised values.
+        Specify geneIds and/or sampleIds to only read these rows/columns from the file, rather than reading the whole
+        matrix and then subsetting. Columns will follow the order of sampleIds, but rows will be in the order of the file
+        and any geneIds not found are ignored, so use .loc[geneIds] on the result if order or missing ids matter.
         """
-        return pandas.read_csv(self.expressionFilePath(filtered=filtered), sep="\t", index_col=0)
+        filepath = self.expressionFilePath(filtered=filtered)
+        if geneIds is None and sampleIds is None:
+            return pandas.read_csv(filepath, sep="\t", index_col=0)
+
+        usecols = None
+        if sampleIds is not None:  # read the header only to work out column positions
+            sampleIds = list(sampleIds)
+            columns = pandas.read_csv(filepath, sep="\t", index_col=0, nrows=0).columns
+            positions = columns.get_indexer(sampleIds)
+            if (positions==-1).any():
+                raise KeyError("Sample ids not found in expression matrix: %s" % [sampleIds[i] for i in numpy.where(positions==-1)[0]])
+            usecols = [0] + [position+1 for position in positions]
+
+        if geneIds is None:
+            df = pandas.read_csv(filepath, sep="\t", index_col=0, usecols=usecols)
+        else:  # read in chunks, only keeping matching rows, so the full matrix is never held in memory
+            geneIds = set(geneIds)
+            reader = pandas.read_csv(filepath, sep="\t", index_col=0, usecols=usecols, chunksize=10000)
+            df = pandas.concat([chunk[chunk.index.isin(geneIds)] for chunk in reader])
+        return df if sampleIds is None else df[sampleIds]
 
     def datasetIds(self):
         """Return all dataset ids in this atlas as a list. Note that each element will be integer type.
@@ -137,10 +166,9 @@ class Atlas(object):
     def geneInfo(self):
         """Return a pandas DataFrame of information about all genes in the atlas, after reading the genes.tsv
         file in the atlas file directory. Ensembl ids form the index.
+        The file is only parsed once per atlas version - this returns a copy of the cached data frame.
         """
-        df = pandas.read_csv(os.path.join(self.atlasFilePath, "genes.tsv"), sep="\t", index_col=0)
-        df.index.name = 'ensembl'
-        return df
+        return _geneInfo(os.path.realpath(self.atlasFilePath)).copy()
 
     def coloursAndOrdering(self):
         """Return dictionaries of colours and ordering of sample type items based on "colours.json" file inside the
@@ -316,7 +344,7 @@ class Atlas(object):
         notFound = set(geneIds).difference(filtered.union(unfiltered))
 
         # Work out subset of expression matrix to use
-        df = self.expressionMatrix(filtered=True).loc[list(filtered)]
+        df = self.expressionMatrix(filtered=True, geneIds=filtered)
         samples = self.sampleMatrix()
 
         if len(df)<=1:  # Not enough common gene (one gene can't be used to calculate distance matrix)
@@ -334,14 +362,20 @@ class Atlas(object):
         if len(df.columns)<=1:  # application of subset + groupby reduced the matrix too much
             return {'dataframe':pandas.DataFrame(), 'error':'Not enough samples to render a heatmap. Try a different subset of samples or no subset.'}
         
-        # Transform values according to relativeValue
+        # Transform values according to relativeValue - subtractions are done in place on a single copy of the values
         if relativeValue=='rowAverage':
-            df = df.sub(df.mean(axis=1), axis=0)
+            values = df.to_numpy(dtype=float, copy=True)
+            values -= numpy.nanmean(values, axis=1, keepdims=True)
+            df = pandas.DataFrame(values, index=df.index, columns=df.columns)
         elif relativeValue=='zscore':  # use zscore on each row
-            from scipy.stats import zscore
-            df = df.apply(zscore, axis=1)
+            # rows with constant values have zero variance and come out as NaN, which can't be clustered or sent as json - use 0
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                values = zscore(df.to_numpy(dtype=float), axis=1)
+            df = pandas.DataFrame(values, index=df.index, columns=df.columns).fillna(0)
         elif relativeValue in df.columns:  # subtract this for each value
-            df = df.sub(df[relativeValue], axis=0)
+            values = df.to_numpy(dtype=float, copy=True)
+            values -= values[:,[df.columns.get_loc(relativeValue)]]
+            df = pandas.DataFrame(values, index=df.index, columns=df.columns)
         
         # Ordering of the columns of df may be specified or clustered
         ordered = self.coloursAndOrdering()['ordering']
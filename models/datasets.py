@@ -22,12 +22,21 @@ only held in text files.
  7157, 7190, 7255, 7257, 7285, 7286, 7292, 7327, 7346, 7377]
 
 """
-import pymongo, os, pandas, numpy, anndata
-from models.utilities import mongoClient
+import pymongo, os, pandas, numpy, anndata, threading
+from joblib import Memory
+from models.utilities import mongoClient, ttlCache, readExpressionTsv
 from models.atlases import Atlas
 
 database = mongoClient()["dataportal"]
 
+# PyTables isn't thread safe, so h5 files are read under this lock when expression matrices are read from multiple threads
+_hdf5Lock = threading.Lock()
+
+# Optional on-disk cache of processed expression matrices (eg. cpm after log2), used by analyses which read many datasets
+# on each request. Set EXPRESSION_CACHE_FILEPATH to a directory to turn it on - caching is disabled if it's not set.
+# Cached arrays are memory mapped read only, so repeated reads are served from the page cache without copying.
+_expressionCache = Memory(os.environ.get("EXPRESSION_CACHE_FILEPATH"), mmap_mode='r', verbose=0)
+
 # These datasets have entries in the metadata table but are not ready to be exposed to the public - such as 6131, 
 # which is not in the normal format. Hence by default, datasetMetadataFromDatasetIds() function here 
 # will exclude this hard coded list of datasets. You can still access these by using Dataset() initialiser.
@@ -100,6 +109,22 @@ def datasetIdsFromFields(platform_type=[], projects=[], organism=['homo sapiens'
 
     return [] if datasetIds is None else list([dsId for dsId in datasetIds if dsId not in _exclude_list])
 
+@ttlCache(seconds=60)
+def cachedDatasetIdsFromFields(platform_type=(), projects=(), organism=('homo sapiens',), status=(), publicOnly=True):
+    """Same as datasetIdsFromFields, but the result is cached for a minute, since this is called by analyses
+    on every request and the dataset ids rarely change. Use tuples rather than lists for arguments here.
+    Returns a tuple, so the cached value can't be modified by the caller.
+    """
+    return tuple(datasetIdsFromFields(platform_type=list(platform_type), projects=list(projects), organism=list(organism), 
+                                      status=list(status), publicOnly=publicOnly))
+
+@_expressionCache.cache
+def _cachedExpressionMatrix(datasetId, key, applyLog2, modifiedTime):
+    """Used by Dataset.expressionMatrix(cached=True). modifiedTime of the expression file is part of the cache key,
+    so the cache entry is not used if the file is updated.
+    """
+    return Dataset(datasetId).expressionMatrix(key=key, applyLog2=applyLog2)
+
 def datasetIdFromName(name, publicOnly=True):
     params = {'name':name}
     if publicOnly:
@@ -232,15 +257,21 @@ def dataAsZipfile(datasetIds, publicOnly=True):
     # Create a name for the zip file using string and numpy.random
     randString = ''.join(numpy.random.choice(list(string.ascii_lowercase), size=5))
 
+    datasetIds = list(datasetIds)  # may be an iterator (eg. map), which is used more than once below
+
     # Filter out any
     if publicOnly:
         datasetIds = set(datasetIds).intersection(set(datasetIdsFromFields(organism=['all'], publicOnly=publicOnly)))
 
+    # Fetch metadata of all datasets in one query, rather than one query per Dataset instance
+    cursor = database["datasets"].find({"dataset_id": {"$in": list(datasetIds)}}, {"_id":0})
+    metadataFromDatasetId = dict([(item['dataset_id'], item) for item in cursor])
+
     # Write to file
     filepath = '/tmp/s4m_zipfile_%s.zip' % randString
     with zipfile.ZipFile(filepath, 'w') as zf:
         for datasetId in datasetIds:
-            ds = Dataset(datasetId)
+            ds = Dataset(datasetId, metadata=metadataFromDatasetId.get(datasetId))
             metadata = pandas.DataFrame.from_dict(ds.metadata(), orient='index', columns=['value'])
             metadata.index.name = 'key'
             zf.writestr("%s_samples.tsv" % datasetId, ds.samples().to_csv(sep="\t"))
@@ -351,14 +382,16 @@ class Dataset(object):
     # All available platform_type values
     platform_types = ["Microarray", "RNASeq", "scRNASeq", "other"]
 
-    def __init__(self, datasetId):
+    def __init__(self, datasetId, metadata=None):
         """Initialise a dataset with Id. Note that id is an integer, and will be coherced into one.
+        If metadata of the dataset has already been fetched from the database (eg. for many datasets at once),
+        it can be passed in as a dictionary to save another query.
         """
         self.datasetId = int(datasetId)
 
         # Make a query to database for dataset metadata now, so if we try to create an instance with 
         # no matching dataset id, we can throw an exception
-        result = database["datasets"].find_one({"dataset_id": self.datasetId}, {"_id":0})
+        result = metadata if metadata is not None else database["datasets"].find_one({"dataset_id": self.datasetId}, {"_id":0})
         if not result:
             raise DatasetIdNotFoundError("No matching dataset id found in database:<%s>" % self.datasetId)
         self._metadata = result
@@ -391,7 +424,7 @@ class Dataset(object):
         return pandas.DataFrame(cursor).set_index("sample_id") if cursor.count()!=0 else pandas.DataFrame()
 
     # expression matrix -------------------------------------
-    def expressionMatrix(self, key="raw", applyLog2=False):
+    def expressionMatrix(self, key="raw", applyLog2=False, cached=False):
         """Return expression matrix for this dataset as a pandas DataFrame.
         key may be one of ['raw','genes','cpm'].
 
@@ -399,6 +432,9 @@ class Dataset(object):
         For RNASeq data, 'raw' and 'genes' are the same, while 'cpm' calculates cpm values.
 
         applyLog2 will apply log2(df+1) if platform_type is RNASeq and max value is greater than 100.
+
+        If cached=True and EXPRESSION_CACHE_FILEPATH is set, the processed matrix is read from the on-disk cache
+        (or written to it the first time). Values of the returned data frame are read only in this case.
         """
         # First get filepath to the expression matrix - always fetch h5 file if we can for speed
         isMicroarray = self.platformType()=='Microarray'
@@ -410,10 +446,14 @@ class Dataset(object):
             if key=='raw': key = 'genes'
             filepath = self.expressionFilePath(hdf5=True)
 
+        if cached and _expressionCache.location is not None:
+            return _cachedExpressionMatrix(self.datasetId, key, applyLog2, os.path.getmtime(filepath))
+
         if filepath.endswith('.h5'):
-            df = pandas.read_hdf(filepath, key='genes')
+            with _hdf5Lock:
+                df = pandas.read_hdf(filepath, key='genes')
         else:
-            df = pandas.read_csv(filepath, sep="\t", index_col=0)
+            df = readExpressionTsv(filepath)
 
         if not isMicroarray and key=='cpm':
             df = cpm(df)
@@ -493,10 +533,10 @@ class Dataset(object):
         if geneId not in df.index:
             return None
         samples = self.samples()
-        values = df.loc[geneId, samples.index]
-        sampleIds1 = samples[samples[sampleGroup]==sampleGroupItems[0]].index
-        sampleIds2 = samples[samples[sampleGroup]==sampleGroupItems[1]].index
-        result = ttest_ind(values[sampleIds1], values[sampleIds2])
+        # align gene values to samples once, then select each group with boolean masks rather than by sample ids
+        values = df.loc[geneId, samples.index].to_numpy()
+        groups = samples[sampleGroup].to_numpy()
+        result = ttest_ind(values[groups==sampleGroupItems[0]], values[groups==sampleGroupItems[1]])
 
         return {'statistic': result.statistic, 'pvalue': result.pvalue}
 
@@ -15,14 +15,93 @@ performing gene expression analyses across multiple datasets happens often, so i
     return geneIds
 
 """
-import requests, os, pandas, numpy, json, anndata
+import requests, os, pandas, numpy, json, anndata, itertools
+from concurrent.futures import ThreadPoolExecutor
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
 from models import datasets
 from models.utilities import mongoClient
 
-def sampleGroupToGenes(sampleGroup, sampleGroupItem, sampleGroupItem2=None, cutoff=20, scoringMethod='max'):
+# numba is optional - if it's not installed, scoring falls back to numpy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Number of worker processes used by sampleGroupToGenes for each request. Each worker holds a whole expression matrix,
+# so keep this small on a server handling concurrent requests. Set SAMPLE_GROUP_TO_GENES_JOBS to change it (-1 for all cores).
+_defaultJobs = int(os.environ.get("SAMPLE_GROUP_TO_GENES_JOBS", 2))
+
+def _meanMinusOthersNumpy(values, groupMask, otherMask, useMax):
+    other = values[:,otherMask]
+    return numpy.nanmean(values[:,groupMask], axis=1) - (numpy.nanmax(other, axis=1) if useMax else numpy.nanmean(other, axis=1))
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _meanMinusOthersNumba(values, groupMask, otherMask, useMax):
+        out = numpy.empty(values.shape[0])
+        for i in prange(values.shape[0]):
+            groupSum, groupCount, otherSum, otherCount, otherMax = 0.0, 0, 0.0, 0, -numpy.inf
+            for j in range(values.shape[1]):
+                value = values[i,j]
+                if numpy.isnan(value): continue
+                if groupMask[j]:
+                    groupSum += value
+                    groupCount += 1
+                if otherMask[j]:
+                    otherSum += value
+                    otherCount += 1
+                    if value>otherMax: otherMax = value
+            if groupCount==0 or otherCount==0:
+                out[i] = numpy.nan
+            elif useMax:
+                out[i] = groupSum/groupCount - otherMax
+            else:
+                out[i] = groupSum/groupCount - otherSum/otherCount
+        return out
+
+def meanMinusOthers(values, groupMask, otherMask, scoringMethod='max'):
+    """Return mean of values in columns of groupMask minus max (or mean if scoringMethod!='max') of values in columns
+    of otherMask, for each row of the 2d numpy array values. NaN values are skipped, as pandas would do.
+    Uses a numba kernel (one pass over each row, parallel across rows) if numba is installed.
+    """
+    if njit is None:
+        return _meanMinusOthersNumpy(values, groupMask, otherMask, scoringMethod=='max')
+    if values.dtype!=numpy.float32:
+        values = numpy.asarray(values, dtype=numpy.float64)
+    return _meanMinusOthersNumba(values, numpy.asarray(groupMask, dtype=numpy.bool_), 
+                                 numpy.asarray(otherMask, dtype=numpy.bool_), scoringMethod=='max')
+
+def _scoreDataset(datasetId, sampleIds, groupMask, otherMask, scoringMethod):
+    """Return positive scores of genes for a single dataset used by sampleGroupToGenes, as a pandas Series.
+    This is a top level function so that it can be run in worker processes.
+    """
+    exp = datasets.Dataset(datasetId).expressionMatrix(key='cpm', applyLog2=True, cached=True)
+
+    # Work out masks over the columns of the matrix from column positions of the samples, rather than making a copy
+    # of exp subset on sampleIds
+    positions = exp.columns.get_indexer(sampleIds)
+    if (positions==-1).any():
+        raise KeyError("Sample ids not found in expression matrix of dataset %s" % datasetId)
+    groupColumns, otherColumns = numpy.zeros(exp.shape[1], dtype=bool), numpy.zeros(exp.shape[1], dtype=bool)
+    groupColumns[positions[groupMask]] = True
+    otherColumns[positions[otherMask]] = True
+
+    # Calculate the difference between mean of sampleGroupItem samples vs max of other in sampleGroup
+    # - float32 values are enough for ranking and halve the memory read by the reduction
+    values = exp.to_numpy(dtype=numpy.float32)
+    diff = pandas.Series(meanMinusOthers(values, groupColumns, otherColumns, scoringMethod), index=exp.index)
+
+    # Only keep +ve scores
+    return diff[diff>0]
+
+def sampleGroupToGenes(sampleGroup, sampleGroupItem, sampleGroupItem2=None, cutoff=20, scoringMethod='max', nJobs=None):
     """Given a sampleGroup and sampleGroupItem, (eg cell_type=monocyte), loop through each dataset which
     contains this sample and calculate genes for high expression.
+    Datasets are scored in parallel using nJobs worker processes (-1 to use all cores, 1 to run serially),
+    which defaults to _defaultJobs.
     """
+    if nJobs is None: nJobs = _defaultJobs
     if sampleGroupItem2=='': sampleGroupItem2 = None
 
     # Find records in samples collection matching sampleGroupItem - just get dataset ids for now
@@ -30,79 +109,95 @@ def sampleGroupToGenes(sampleGroup, sampleGroupItem, sampleGroupItem2=None, cuto
     datasetIds = [item['dataset_id'] for item in cursor]
 
     # Restrict to public human datasets, Microarray and RNASeq only
-    datasetIds = list(set(datasets.datasetIdsFromFields()).intersection(set(datasetIds)))
+    datasetIds = list(set(datasets.cachedDatasetIdsFromFields()).intersection(set(datasetIds)))
 
     # Get all samples for these datasetIds - quicker to make one mongo query than to loop through Dataset object
     cursor = mongoClient()["dataportal"]["samples"].find({'dataset_id': {'$in':datasetIds}}, {"_id":0})
     allSamples = pandas.DataFrame(cursor).set_index("sample_id") if cursor.count()!=0 else pandas.DataFrame()
 
+    if len(allSamples)==0:
+        return {'rankScore':pandas.DataFrame(), 'totalDatasets':0}
+
     # This will hold genes as index and rank score for each gene in each dataset
-    rankScore = pandas.Series(dtype=float)
-    datasetIds = {}
+    rankScores = []  # rank scores of each dataset, concatenated once after the loop
+    pairs = []  # data frames of (geneId, datasetId) pairs for each dataset
     uniqueDatasetIds = set()  # keep track of all dataset ids used for scoring
 
+    # Work out sample group membership once for all samples using categorical codes, rather than comparing strings
+    # for each dataset. Null values get code -1, so they're counted as "other" just like a string comparison would.
+    groups = pandas.Categorical(allSamples[sampleGroup])
+    groupMask = numpy.asarray(groups==sampleGroupItem)
+    otherMask = ~groupMask if sampleGroupItem2 is None else numpy.asarray(groups==sampleGroupItem2)
+    positionsFromDatasetId = allSamples.groupby('dataset_id').indices
+
+    # Work out which datasets to score first, so the expensive part can be sent to worker processes
+    jobs = []
     for datasetId in allSamples['dataset_id'].unique():
-        samples = allSamples[allSamples['dataset_id']==datasetId]
-        
+        positions = positionsFromDatasetId[datasetId]
+
         # ignore dataset if there's only one sampleGroupItem as we can't make comparisons
-        if len(samples[sampleGroup].unique())==1: continue
-        
+        if len(numpy.unique(groups.codes[positions]))==1: continue
+
         if not sampleGroupItem2 is None: # further ignore if this isn't found in the dataset
             # we could do this in the mongo search above but that first search is fast enough
-            if not sampleGroupItem2 in samples[sampleGroup].tolist(): continue
+            if not otherMask[positions].any(): continue
 
-        exp = datasets.Dataset(datasetId).expressionMatrix(key='cpm', applyLog2=True)
-        exp = exp[samples.index]
-        
-        # Calculate the difference between mean of sampleGroupItem samples vs max of other in sampleGroup
-        df1 = exp[samples[samples[sampleGroup]==sampleGroupItem].index].mean(axis=1)
-        if sampleGroupItem2 is None: 
-            sampleIds = samples[samples[sampleGroup]!=sampleGroupItem].index
-        else:
-            sampleIds = samples[samples[sampleGroup]==sampleGroupItem2].index
+        jobs.append((datasetId, allSamples.index[positions].tolist(), groupMask[positions], otherMask[positions]))
 
-        if scoringMethod=='max': 
-            df2 = exp[sampleIds].max(axis=1)
-        else:
-            df2 = exp[sampleIds].mean(axis=1)
-        diff = df1 - df2
+    diffs = Parallel(n_jobs=nJobs, backend='loky')(delayed(_scoreDataset)(*job, scoringMethod) for job in jobs)
 
-        # Only keep +ve scores
-        diff = diff[diff>0]
+    for (datasetId,_,_,_),diff in zip(jobs, diffs):
+        if len(diff)==0: continue
 
         # Remember dataset id for all the genes in diff
-        for geneId in diff.index:
-            if geneId not in datasetIds: datasetIds[geneId] = []
-            datasetIds[geneId].append(datasetId)
-            uniqueDatasetIds.add(datasetId)
+        pairs.append(pandas.DataFrame({'geneId':diff.index, 'datasetId':str(datasetId)}))
+        uniqueDatasetIds.add(datasetId)
 
-        # Row concatenate this Series for all datasets after converting diff into normalised ranks 
+        # Keep this Series for all datasets after converting diff into normalised ranks
         # (so 0 is lowest diff value, 1 is highest)
-        rankScore = pandas.concat([rankScore, diff.rank()/len(diff)])
+        rankScores.append(pandas.Series(rankdata(diff.values)/len(diff), index=diff.index))
 
-    # Create data frame of average rank values
-    df = pandas.DataFrame({'meanRank': rankScore.groupby(rankScore.index).mean()})
+    rankScore = pandas.concat(rankScores) if rankScores else pandas.Series(dtype=float)
+
+    # Create data frame of average rank values - the same groupby also gives the number of datasets for each gene
+    grouped = rankScore.groupby(level=0)
+    df = pandas.DataFrame({'meanRank': grouped.mean()})
 
     if len(df)==0:
         return {'rankScore':pandas.DataFrame(), 'totalDatasets':len(uniqueDatasetIds)}
 
     # Add datasetIds and count of them
-    df['datasetIds'] = [','.join(map(str,datasetIds[geneId])) for geneId in df.index]
-    df['count'] = [len(datasetIds[geneId]) for geneId in df.index]
+    df['datasetIds'] = pandas.concat(pairs, ignore_index=True).groupby('geneId', sort=False)['datasetId'].agg(','.join)
+    df['count'] = grouped.size()
     df.index.name = "geneId"
 
-    # Apply cutoff - this is first applied to each combination of geneId-count
-    if cutoff:
-        df = pandas.concat([df[df['count']==count].sort_values('meanRank', ascending=False).iloc[:cutoff,:] for count in df['count'].unique()])
-
+    # Sort by count then meanRank and apply cutoff. Taking the top rows of each count first isn't needed, since the
+    # top rows overall after this sort are always within the top rows of their count.
     df = df.sort_values(['count','meanRank'], ascending=False)
-
-    # apply cutoff again, just to make it less confusing for the output
     if cutoff:
         df = df.iloc[:cutoff,:]
      
     return {'rankScore':df, 'totalDatasets':len(uniqueDatasetIds)}
 
+def _samplesAndGeneValues(datasetId, geneId, sampleGroup):
+    """Return sampleGroup values of samples in a dataset (as categorical Series) and expression values of geneId
+    aligned to these samples, for geneToSampleGroups.
+    Returns None if the dataset can't be used. Only the gene's values are returned, so the full matrix can be freed.
+    """
+    ds = datasets.Dataset(datasetId)
+    samples = ds.samples()
+    samples = samples[samples[sampleGroup].notnull()] # focus on only non-null cell types
+    #samples = samples[samples[sampleGroup].isin(sampleGroupItems)]  # other sampleGroupItems are too infrequent
+    groups = samples[sampleGroup].astype('category')  # unique and groupby work on integer codes
+    if len(groups.cat.categories)<2:  # we need at least 2 different cell types which aren't null
+        return None
+    df = ds.expressionMatrix(key='cpm', cached=True)
+    if geneId not in df.index or len(df.columns.intersection(samples.index))==0:
+        return None
+
+    # get values of the gene aligned to samples
+    return groups, df.loc[geneId][samples.index.intersection(df.columns)]
+
 def geneToSampleGroups(geneId, sampleGroup='cell_type'):
     """Given a gene, loop through all datasets and calculate expression score for items in sampleGroup.
     The score is calculated by first calculating mean of all samples in that sampleGroup, then subtracting
@@ -111,45 +206,43 @@ def geneToSampleGroups(geneId, sampleGroup='cell_type'):
     """
 
     # Restrict to public human datasets, Microarray and RNASeq only
-    allDatasetIds = datasets.datasetIdsFromFields(platform_type=['Microarray','RNASeq'])
+    allDatasetIds = datasets.cachedDatasetIdsFromFields(platform_type=('Microarray','RNASeq'))
 
     # Also no need to look at cell types with only a few samples assigned to them
     #sampleCount = datasets.allValues('samples', sampleGroup, includeCount=True, excludeDatasets=datasets._exclude_list)
     #sampleGroupItems =  sampleCount[sampleCount>10].index.tolist()
 
-    # DataFrame to hold the result
-    result = pandas.DataFrame(columns=['score','datasetIds'])
+    # Lists to hold the result - sampleGroupItem, score and dataset id for each positive score, made into a DataFrame at the end
+    sampleGroupItems, scores, datasetIds = [], [], []
 
-    for datasetId in allDatasetIds:
-        ds = datasets.Dataset(datasetId)
-        samples = ds.samples()
-        samples = samples[samples[sampleGroup].notnull()] # focus on only non-null cell types
-        #samples = samples[samples[sampleGroup].isin(sampleGroupItems)]  # other sampleGroupItems are too infrequent
-        if len(samples[sampleGroup].unique())<2:  # we need at least 2 different cell types which aren't null
-            continue
-        df = ds.expressionMatrix(key='cpm')
-        if geneId not in df.index or len(df.columns.intersection(samples.index))==0:
-            continue
+    # Read samples and gene values for datasets in a pool of threads, so that database queries and file reads of the
+    # next datasets overlap with scoring here. map submits all datasets up front and yields results in order.
+    # Each thread holds a whole matrix while it reads the gene's values, and h5 reads are serialised by _hdf5Lock
+    # anyway, so only a couple of threads are used: enough to overlap the mongo query with the file read.
+    loader = lambda datasetId: _samplesAndGeneValues(datasetId, geneId, sampleGroup)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for datasetId,item in zip(allDatasetIds, executor.map(loader, allDatasetIds)):
+            if item is None: continue
+            groups, values = item
 
-        # get values of the gene aligned to samples
-        values = df.loc[geneId][samples.index.intersection(df.columns)]
+            mean = values.groupby(groups, observed=True).mean().round()
+            var = mean.var()
+            if var<1: continue
 
-        mean = values.groupby(samples[sampleGroup]).mean().round()
-        var = mean.var()
-        if var<1: continue
+            # only keep those above median
+            diff = mean - mean.median()
+            diff = diff[diff>0]
 
-        # only keep those above median
-        diff = mean - mean.median()
-        diff = diff[diff>0]
+            # rank = mean.rank()/len(mean)  # {'fibroblast': 0.5, 'peripheral blood mononuclear cell': 1.0}
+            # rank = rank.sort_values(ascending=False)
 
-        # rank = mean.rank()/len(mean)  # {'fibroblast': 0.5, 'peripheral blood mononuclear cell': 1.0}
-        # rank = rank.sort_values(ascending=False)
-
-        # Create a data frame with all the info and row concatenate this for all datasets
-        df = pandas.DataFrame({'score':diff, 'datasetIds':[datasetId for item in diff.index]})
-        result = pandas.concat([result,df])
+            # Append all the info for this dataset
+            sampleGroupItems.extend(diff.index)
+            scores.extend(diff.tolist())
+            datasetIds.extend([datasetId]*len(diff))
 
     # Transform result by grouping sampleGroupItem values
+    result = pandas.DataFrame({'score':scores, 'datasetIds':datasetIds}, index=sampleGroupItems)
     result = result.groupby(result.index).agg({'score':list, 'datasetIds':list})
 
     # Add other properties
@@ -266,6 +359,9 @@ def createGeneset(msigName=None, name=None, geneSymbols=[], sampleGroupItem='cel
         else:
             geneIdsFromSymbol[item['symbol']] = [item['ensembl']['gene']]
 
+    # All gene ids of the geneset, worked out once rather than for each dataset
+    candidateGeneIds = pandas.Index(list(itertools.chain.from_iterable(geneIdsFromSymbol.values()))).unique()
+
     # Loop through each dataset in the system
     scores = pandas.DataFrame(columns=['var','high','low','diff'])
     scores.index.name = 'datasetId'
@@ -283,7 +379,7 @@ def createGeneset(msigName=None, name=None, geneSymbols=[], sampleGroupItem='cel
         
         exp = ds.expressionMatrix(key='cpm', applyLog2=True)
         # Take mean of geneset and mean across sampleGroupItem, and evaluate variance of these means
-        df = exp.loc[exp.index.intersection(sum(list(geneIdsFromSymbol.values()),[]))]
+        df = exp.loc[exp.index.intersection(candidateGeneIds)]
         if len(samples.index.intersection(df.columns))==0: continue
         if len(df)>0:
             group = df[samples.index].groupby(samples[sampleGroupItem], axis=1)
@@ -350,6 +446,23 @@ def test_genesetCollections():
 def test_scoreGeneset():
     scoreGeneset()
 
+def test_meanMinusOthers():
+    # numba and numpy paths should agree, including rows with some or all values missing
+    if njit is None: return
+    values = numpy.random.RandomState(0).normal(size=(50,12))
+    values[3,[0,5]] = numpy.nan
+    values[7,:4] = numpy.nan  # all of the group missing
+    values[9,4:] = numpy.nan  # all of the others missing
+    values[11] = numpy.nan
+    groupMask = numpy.arange(12)<4
+    otherMask = ~groupMask
+    for dtype in [numpy.float64, numpy.float32]:
+        for scoringMethod in ['max', 'mean']:
+            expected = _meanMinusOthersNumpy(values.astype(dtype), groupMask, otherMask, scoringMethod=='max')
+            result = meanMinusOthers(values.astype(dtype), groupMask, otherMask, scoringMethod)
+            assert numpy.allclose(result, expected, rtol=1e-5, equal_nan=True)
+    assert numpy.isnan(result[[7,9,11]]).all() and not numpy.isnan(result[3])
+
 # def test_geneset():
 #     gs = genesetFromName('NABA_COLLAGENS')
 #     df = pandas.DataFrame.from_records(gs['scores']).set_index('index')
@@ -1,7 +1,100 @@
 """
 Collection of mostly small functions for convenience used by all models.
 """
-import pymongo, os
+import pymongo, os, time, functools, threading, pandas
+from pandas._libs.parsers import STR_NA_VALUES
+
+# pyarrow is optional - if it's not installed (or pandas is too old for engine="pyarrow"), pandas' C parser is used
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+_pyarrowEngine = pyarrow is not None and tuple(int(item) for item in pandas.__version__.split(".")[:2])>=(1,4)
 
 def mongoClient():
     return pymongo.MongoClient(os.environ.get("MONGO_URI"))
+
+def _readExpressionTsvPyarrow(filepath):
+    """Read filepath like pandas.read_csv(filepath, sep="\t", index_col=0), but with pyarrow's multithreaded parser.
+    Column names must be unique, since pyarrow doesn't de-duplicate them with .1, .2 etc like the C parser.
+    """
+    df = pandas.read_csv(filepath, sep="\t", engine="pyarrow")
+    df = df.set_index(df.columns[0])
+    if df.index.name=='': df.index.name = None  # same as the C parser with blank header
+
+    # The C parser reads NA strings in the index column as NaN and gives all NA columns float dtype,
+    # which pyarrow may not do (depending on version)
+    if pandas.api.types.is_string_dtype(df.index.dtype):
+        df.index = df.index.where(~df.index.isin(STR_NA_VALUES))
+    for position in range(df.shape[1]):
+        if not pandas.api.types.is_numeric_dtype(df.dtypes.iloc[position]) and df.iloc[:,position].isna().all():
+            df[df.columns[position]] = df.iloc[:,position].astype(float)
+    return df
+
+def readExpressionTsv(filepath):
+    """Return expression matrix in a tab separated file as a pandas DataFrame, using the first column as index.
+    Expression files can be hundreds of MB, so pyarrow's multithreaded parser is used if it's available (pandas>=1.4),
+    otherwise pandas' C parser. Both give the same result. Parse errors are raised, not retried with the other parser.
+    """
+    if _pyarrowEngine:
+        with open(filepath) as file:
+            columns = file.readline().rstrip("\r\n").split("\t")[1:]
+        if len(set(columns))==len(columns):
+            return _readExpressionTsvPyarrow(filepath)
+    return pandas.read_csv(filepath, sep="\t", index_col=0)
+
+def ttlCache(seconds=60, maxsize=32):
+    """Decorator which caches the return value of a function for a number of seconds, keyed on its arguments
+    (so arguments must be hashable). Use this instead of functools.lru_cache where the underlying data can change,
+    such as results of a database query. Call func.cache_clear() to empty the cache.
+    The cache is shared by request threads, so it's only accessed under a lock (func itself is called outside it).
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            now = time.time()
+            with lock:
+                entry = cache.get(key)
+            if entry is not None and now - entry[0] < seconds:
+                return entry[1]
+            value = func(*args, **kwargs)
+            with lock:
+                if key not in cache and len(cache)>=maxsize:  # drop the oldest entry
+                    del cache[min(cache, key=lambda item: cache[item][0])]
+                cache[key] = (now, value)
+            return value
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+# ----------------------------------------------------------
+# tests: eg. $nosetests -s <filename>:ClassName.func_name
+# ----------------------------------------------------------
+def test_readExpressionTsv():
+    # pyarrow and C parser should agree on an all NA column, NA row label and integer values, and duplicate
+    # column names should be de-duplicated like the C parser does
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "test.tsv")
+        with open(filepath, "w") as file:
+            file.write("\tS1\tS2\tS3\ng1\t1\t\t0.5\nNA\t3\t\t1.5\ng3\t5\t\t2.5\n")
+        expected = pandas.read_csv(filepath, sep="\t", index_col=0)
+        assert expected['S2'].dtype==float and expected.index.isna()[1]
+        if _pyarrowEngine:
+            pandas.testing.assert_frame_equal(_readExpressionTsvPyarrow(filepath), expected)
+        pandas.testing.assert_frame_equal(readExpressionTsv(filepath), expected)
+
+        with open(filepath, "w") as file:
+            file.write("\tS1\tS2\tS1\ng1\t1\t\t2\ng2\t3\t\t4\n")
+        df = readExpressionTsv(filepath)
+        assert df.columns.tolist()==['S1','S2','S1.1']
+        pandas.testing.assert_frame_equal(df, pandas.read_csv(filepath, sep="\t", index_col=0))
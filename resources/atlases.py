@@ -40,7 +40,7 @@ class Atlas(Resource):
 
         elif item=="expression-values":  # subset expression matrix on gene ids specified - note we're assuming geneIds are all in expressionMatrix(filtered=true)
             geneIds = args.get('gene_id').split(',') if args.get('gene_id') is not None else []
-            df = atlas.expressionMatrix(filtered=filtered).loc[geneIds]
+            df = atlas.expressionMatrix(filtered=filtered, geneIds=geneIds).loc[geneIds]
         
         elif item=="expression-file":  # this is served as a file download regardless of as_file flag
             filepath = atlas.expressionFilePath(filtered=filtered)
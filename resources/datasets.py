@@ -1,6 +1,6 @@
 from flask_restful import reqparse, Resource
-from flask import send_from_directory
-import os, pandas
+from flask import send_from_directory, send_file
+import os, io, tempfile, pandas
 
 from resources import auth
 from models import datasets, genes
@@ -19,6 +19,16 @@ def protectedDataset(datasetId):
     except datasets.DatasetIdNotFoundError:
         raise DatasetIdNotFoundError
 
+def sendDataFrameAsFile(df, filename):
+    """Return a flask response which sends df as a tab separated file download. df is written to an anonymous
+    temporary file (removed when closed, after sending), so large matrices aren't held in memory as text.
+    """
+    text = io.TextIOWrapper(tempfile.TemporaryFile(), encoding='utf-8', newline='')
+    df.to_csv(text, sep='\t')
+    buffer = text.detach()  # the underlying binary file, which flask sends and closes
+    buffer.seek(0)
+    return send_file(buffer, mimetype='text/tab-separated-values', as_attachment=True, attachment_filename=filename)
+
 # ----------------------------------------------------------
 # Working on a single specified dataset
 # ----------------------------------------------------------
@@ -60,11 +70,7 @@ class DatasetSamples(Resource):
             df = df.drop(hideKeys, axis=1).fillna(args.get("na"))
 
             if args.get('as_file').lower().startswith('t'):
-                from tempfile import NamedTemporaryFile
-                from flask import send_file
-                with NamedTemporaryFile() as temp_file:
-                    df.to_csv(temp_file.name, sep='\t')
-                    return send_file(temp_file.name, as_attachment=True, attachment_filename="stemformatics_dataset_%s.samples.tsv" % datasetId)
+                return sendDataFrameAsFile(df, "stemformatics_dataset_%s.samples.tsv" % datasetId)
             else:
                 if args.get('orient')=='records':  # include index
                     df = df.reset_index()
@@ -90,12 +96,7 @@ class DatasetExpression(Resource):
         if args.get('as_file').lower().startswith('t'):  # file download for entire expression matrix - ignore gene_id
             filename = "stemformatics_dataset_%s.%s.tsv" % (datasetId, args.get('key'))  # user will see this name for download
             if ds.metadata()['platform_type']=='RNASeq' and args.get('key')=='cpm': # we don't have cpm saved on file - calculate it and return it
-                from tempfile import NamedTemporaryFile
-                from flask import send_file
-                with NamedTemporaryFile() as temp_file:
-                    df = ds.expressionMatrix(key=args.get('key'))
-                    df.to_csv(temp_file.name, sep='\t')
-                    return send_file(temp_file.name, as_attachment=True, attachment_filename=filename)
+                return sendDataFrameAsFile(ds.expressionMatrix(key=args.get('key')), filename)
             else:
                 filepath = ds.expressionFilePath(args.get('key'))
                 return send_from_directory(os.path.dirname(filepath), os.path.basename(filepath), as_attachment=True, attachment_filename=filename)
@@ -239,7 +240,7 @@ class DatasetSearch(Resource):
         projects = args.get('projects').split(',') if args.get('projects') else []
         organism = args.get('organism').split(',') if args.get('organism') else []
         if (datasetIds is None or len(datasetIds)>0) and (platformType or projects or organism):
-            ids = datasets.datasetIdsFromFields(platform_type=platformType, projects=projects, organism=organism)
+            ids = datasets.cachedDatasetIdsFromFields(platform_type=tuple(platformType), projects=tuple(projects), organism=tuple(organism))
             datasetIds = ids if datasetIds is None else datasetIds.intersection(set(ids))
 
         # When we fetch the data frame, apply public/private status
@@ -253,30 +254,26 @@ class DatasetSearch(Resource):
             return df.reset_index().to_dict(orient='list')
                     
         # Add sample related columns
+        # - one pass over samples with groupby, rather than masking samples for each dataset
         samples = samples.fillna('[unassigned]')
-        df['samples'] = [len(samples[samples['dataset_id']==index]) for index in df.index]  # number of samples in each dataset
-        df['cell_type'] = [','.join(samples[samples['dataset_id']==index]['cell_type'].unique().tolist()) for index in df.index]
-        df['tissue_of_origin'] = [','.join(samples[samples['dataset_id']==index]['tissue_of_origin'].unique().tolist()) for index in df.index]
+        if len(samples)>0:
+            df['samples'] = samples.groupby('dataset_id').size().reindex(df.index, fill_value=0)  # number of samples in each dataset
+            for column in ['cell_type','tissue_of_origin']:  # drop_duplicates keeps order of appearance, same as unique()
+                values = samples[['dataset_id',column]].drop_duplicates()
+                df[column] = values.groupby('dataset_id', sort=False)[column].agg(','.join).reindex(df.index, fill_value='')
+        else:
+            df['samples'], df['cell_type'], df['tissue_of_origin'] = 0, '', ''
 
         # Add some derived columns for convenience
-        displayNames, pubmedIds, years = [], [], []
         if len(df)==0: # no matching results found - need these columns anyway
-            df['name'] = []
-            df['projects'] = []
-            df['platform_type'] = []
-
-        for name in df["name"]:
-            items = name.split("_")
-            pubmedIds.append(items[2])
-            try:
-                years.append(int(items[1]))
-                displayNames.append("{} ({})".format(items[0],items[1]))
-            except ValueError:  # assume wrong year string to convert to int
-                years.append(0)
-                displayNames.append("{}".format(items[0]))
-        df["display_name"] = displayNames
-        df["pubmed_id"] = pubmedIds
-        df["year"] = years
+            for column in ['name','projects','platform_type','display_name','pubmed_id','year']:
+                df[column] = []
+        else:  # name is in the form of "author_year_pubmedId", so split all names at once into these parts
+            parts = df["name"].str.split("_", expand=True).reindex(columns=[0,1,2])
+            isYear = parts[1].fillna("").str.isdigit()  # assume wrong year string if it's not a number
+            df["display_name"] = parts[0].where(~isYear, parts[0] + " (" + parts[1] + ")")
+            df["pubmed_id"] = parts[2]
+            df["year"] = parts[1].where(isYear, 0).astype(int)
         
         # Sort
         df = df.sort_values(args.get('sort_field'), ascending=args.get('sort_ascending').lower().startswith('t'))
@@ -3,6 +3,8 @@ Gene expression analysis related resources here.
 """
 from flask_restful import reqparse, Resource
 import os, pandas
+from scipy.cluster.hierarchy import linkage, dendrogram
+from scipy.spatial.distance import pdist
 from models import genes, atlases
 from resources.datasets import protectedDataset, DatasetSearch
 
@@ -47,9 +49,7 @@ class GeneToSampleGroups(Resource):
 
 """Return index of df after hierarchical clustering the rows"""
 def hclusteredRows(df):
-    from scipy.cluster.hierarchy import linkage, dendrogram
-    from scipy.spatial.distance import pdist, squareform
-    clust = linkage(squareform(pdist(df.values, metric='euclidean')), method='complete')
+    clust = linkage(pdist(df.values, metric='euclidean'), method='complete')
     dendro = dendrogram(clust, no_plot=True)
     return df.index[dendro['leaves']]
 
@@ -1,9 +1,26 @@
 import os, re, pandas
 from flask_restful import reqparse, Resource
+from flask import send_from_directory
 
 from resources import auth
 from resources.errors import UserNotAuthenticatedError, DatasetQCFilesMissingError
 from models import datasets
+from models.utilities import ttlCache
+
+# QC directories start with the dataset id
+_qcDirectoryPattern = re.compile(r"^(\d{4})")
+
+@ttlCache(seconds=60)
+def qcDirectoryFromDataset(qcFilepath):
+    """Return a dictionary of path to QC files under qcFilepath, keyed on dataset id (integer).
+    Cached for a minute, since the directory rarely changes between requests.
+    """
+    dfd = {}
+    with os.scandir(qcFilepath) as entries:
+        for entry in entries:
+            match = _qcDirectoryPattern.match(entry.name)
+            if match: dfd[int(match.group(1))] = entry.path
+    return dfd
 
 # ----------------------------------------------------------
 # Governance related dataset access after authentication
@@ -23,11 +40,7 @@ class Governance(Resource):
         """
         # Fetch qc results. These are retrieved from data-source if there's not a local copy already.
         # (to-do: how do we update the local copy if the version at data-source changes?)
-        dfd = {}
-        for item in os.listdir(os.getenv('QC_FILEPATH')):
-            match = re.findall("^\d{4}", item)
-            if len(match)>0: dfd[int(match[0])] = os.path.join(os.getenv("QC_FILEPATH"), item)
-        return dfd
+        return qcDirectoryFromDataset(os.getenv('QC_FILEPATH'))
 
 class DatasetSummary(Governance):
     def get(self):
@@ -58,7 +71,6 @@ class DatasetQCHtml(Governance):
 
         dfd = self.directoryFromDataset()        
         if dfd.get(datasetId):
-            from flask import send_from_directory
             return send_from_directory(dfd[datasetId], filename, as_attachment=True)
         else:
             raise DatasetQCFilesMissingError
@@ -1,7 +1,7 @@
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
-import smtplib, ssl, logging, os
+import smtplib, ssl, logging, os, threading
 
 # ----------------------------------------------------------
 # Steps to allow mail.py to work
@@ -29,6 +29,53 @@ import smtplib, ssl, logging, os
 # Load .env variables
 load_dotenv()
 
+# Set up logger once at import, rather than adding another file handler (and duplicating log lines) on each call
+LOG_FILENAME = 'mail.log'
+logger = logging.getLogger(LOG_FILENAME)
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+  file_handler = logging.FileHandler(LOG_FILENAME)
+  formatter = logging.Formatter('%(asctime)s %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+  file_handler.setFormatter(formatter)
+  logger.addHandler(file_handler)
+
+# Use Gmail SMTP server, with port 587 for TLS
+smtp_server = 'smtp.gmail.com'
+port = 587 
+
+# The logged in SMTP connection is kept open between calls, so we don't pay for a TLS handshake and login on every email.
+# The lock makes sure only one request thread uses the connection at a time.
+_server = None
+_server_lock = threading.Lock()
+
+# Return the logged in SMTP connection, making a new one if there isn't one or the server has closed it.
+# Call while holding _server_lock.
+def _get_server():
+  global _server
+  if _server is not None:
+    try:
+      if _server.noop()[0]==250:  # connection still alive
+        return _server
+    except (smtplib.SMTPException, OSError):
+      pass
+    _close_server()
+
+  server = smtplib.SMTP(smtp_server, port)
+  server.ehlo()  # check connection
+  server.starttls(context=ssl.create_default_context())  # Secure the connection
+  server.ehlo()  # check connection
+  server.login(os.environ["EMAIL_USER"], os.environ["EMAIL_PASS"])
+  _server = server
+  return _server
+
+def _close_server():
+  global _server
+  try:
+    _server.quit()
+  except (smtplib.SMTPException, OSError):
+    pass
+  _server = None
+
 # @param list recipients The recipients email addresses as a list of strings.
 # A bare string will be interpreted as a list with 1 address.
 # Must be either a list of strings, or a single address as a bare string, any other format will not work properly.
@@ -36,22 +83,8 @@ load_dotenv()
 # @param str body The text body of the email.
 def send_mail(recipients, subject, body):
 
-  # Set up logger
-  LOG_FILENAME = 'mail.log'
-  logger = logging.getLogger(LOG_FILENAME)
-  logger.setLevel(logging.INFO)
-  file_handler = logging.FileHandler(LOG_FILENAME)
-  formatter = logging.Formatter('%(asctime)s %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
-  file_handler.setFormatter(formatter)
-  logger.addHandler(file_handler)
-
-  # Use Gmail SMTP server, with port 587 for TLS
-  smtp_server = 'smtp.gmail.com'
-  port = 587 
-
-  # Sender email and password
+  # Sender email
   sender_email = os.environ["EMAIL_USER"]
-  password = os.environ["EMAIL_PASS"]
 
   # Check if input parameter is a bare string, then put in a list
   if(isinstance(recipients,str)):
@@ -67,27 +100,21 @@ def send_mail(recipients, subject, body):
   body_text = MIMEText(body, 'plain')
   msg.attach(body_text)
 
-  context = ssl.create_default_context()
-
-  # Try to log in to server and send email
-  try:
-    server = smtplib.SMTP(smtp_server, port)
-    server.ehlo()  # check connection
-    server.starttls(context=context)  # Secure the connection
-    server.ehlo()  # check connection
-    server.login(sender_email, password)
-
-    # Send email
-    response = server.sendmail(sender_email, recipients, msg.as_string())
-
-  except Exception as e:
-    # Log any error messages to mail.log
-    logger.info(e)
-  finally:
-    # Log successful send mail to mail.log
-    logger.info(recipients)
-    server.quit()
-    return response
+  # Try to log in to server (if not already) and send email
+  response = None
+  with _server_lock:
+    try:
+      server = _get_server()
+      response = server.sendmail(sender_email, recipients, msg.as_string())
+    except Exception as e:
+      # Log any error messages to mail.log, and start with a fresh connection next time
+      logger.info(e)
+      if _server is not None:
+        _close_server()
+
+  # Log send mail to mail.log
+  logger.info(recipients)
+  return response
 
 # ----------------------------------------------------------
 # tests: eg. $nosetests -s <filename>:ClassName.func_name
@@ -7,8 +7,9 @@ To run this script (ensure you're in the application directory):
 Create pca coordinates for all the expression files.
 """
 
-import os, sys, pandas, numpy, shutil
-from sklearn.decomposition import PCA
+import os, sys, pandas, numpy, shutil, json
+import scipy.linalg, scipy.linalg.blas
+from sklearn.utils.extmath import randomized_svd, svd_flip
 
 # append current directoy to path so modules can be imported from models
 sys.path.append(os.path.join(sys.path[0]))
@@ -16,98 +17,265 @@ from models import datasets
 from models import utilities
 
 expressionFilepath = os.environ['EXPRESSION_FILEPATH']
+# Set PCA_CACHE_FILEPATH to a directory to keep float32 .npy copies of the raw matrices used here, so that re-running
+# pca on the same datasets memory maps the values instead of parsing the tsv files again.
+pcaCacheFilepath = os.environ.get('PCA_CACHE_FILEPATH')
 
 # These datasets gave Segmentation fault (core dumped) error on api-dev server, apart from
 # 7139,7077,6128,6645,6992,7204,7194,6309,6572,6599 which give ValueError: Input contains NaN, infinity or a value too large for dtype('float64')
-datasetsToSkip = ['6121', '6128', '6190', '6256', '6271', '6278', '6329', '6353', '6400', 
+datasetsToSkip = frozenset(['6121', '6128', '6190', '6256', '6271', '6278', '6329', '6353', '6400', 
                   '6401', '6418', '6425', '6459', '6461', '6468', '6491', '6518', '6580', 
                   '6586', '6602', '6639', '6645', '6646', '6667', '6668', '6728', '6730', 
                   '6735', '6739', '6741', '6748', '6991', '6992', '7032', '7077', '7128', 
                   '7129', '7135', '7139', '7142', '7168', '7169', '7170', '7192', '7194', 
                   '7200', '7204', '7239', '7243', '7253', '7268', '7327', '7346', '7378', 
                   '7379', '6214', '6231', '6286', '6309', '6385', '6460', '6572', '6599',
-                  '6932', '6936', '7064', '7171', '7254', '7274', '7357', '7387']
+                  '6932', '6936', '7064', '7171', '7254', '7274', '7357', '7387'])
+
+def svd(X, nComponents, exact=False, overwrite=False):
+    """Return (U, s, Vt) of X for at least nComponents, using the first of these that applies:
+    - exact=True: full svd with LAPACK's gesdd driver, regardless of shape.
+    - X has many more columns than rows (eg. samples x genes): all components from the much smaller gram matrix
+      X @ X.T, with Vt returned as None since it's not needed for the coordinates.
+    - all components are needed anyway (nComponents >= min(X.shape)): full svd with gesdd.
+    - otherwise: randomized svd for the leading nComponents.
+    Signs are flipped the same way as sklearn, so that results are deterministic.
+    Use overwrite=True to let LAPACK work in X's buffer (X should then be Fortran ordered), which destroys X.
+    """
+    if not exact and X.shape[1]>4*X.shape[0]:
+        return gramSvd(X)
+    if exact or nComponents>=min(X.shape):
+        # check_finite=False skips a scan of X - values are already checked by the caller (fillna)
+        U, s, Vt = scipy.linalg.svd(X, full_matrices=False, lapack_driver='gesdd', check_finite=False, overwrite_a=overwrite)
+        U, Vt = svd_flip(U, Vt)
+        return U, s, Vt
+    return randomized_svd(X, n_components=nComponents, n_iter=4, random_state=0)
+
+def gramSvd(X):
+    """Return (U, s, None) of X from the eigen decomposition of X @ X.T, with components in descending order.
+    For a short-fat matrix this is much faster than svd of X itself: O(m^2 n) to form the gram matrix using syrk,
+    then O(m^3) for eigh.
+    """
+    syrk = scipy.linalg.blas.get_blas_funcs('syrk', (X,))
+    G = syrk(1.0, X).astype(numpy.float64)  # only upper triangle is filled, which is what eigh reads with lower=False
+    w, U = scipy.linalg.eigh(G, lower=False, overwrite_a=True, check_finite=False)
+    w, U = w[::-1], U[:,::-1]
+    s = numpy.sqrt(numpy.clip(w, 0, None))
+    # flip signs the same way as svd_flip with u_based_decision
+    signs = numpy.sign(U[numpy.argmax(numpy.abs(U), axis=0), range(U.shape[1])])
+    return U * signs, s, None
+
+def pca(values, varianceCutoff=0.99, initialComponents=50, exact=False, dtype=numpy.float32):
+    """Return PCA coordinates and attributes of values (numpy array of samples x genes) as a tuple of (numpy array, DataFrame),
+    keeping the number of components needed to explain at least varianceCutoff of the total variance.
+    This gives the same results as sklearn's PCA(n_components=0.99, svd_solver='full'), but uses randomized svd to compute
+    only the leading components - starting with initialComponents and doubling until the cutoff is reached, since
+    usually only a handful of components explain 99% of variance, and a full svd of a large matrix is slow.
+    Use exact=True to always compute the full svd.
+    The svd is computed in float32 by default, which halves memory and roughly doubles LAPACK throughput - components
+    which explain 99% of variance are not sensitive to the lost precision. Returned values are float64.
+    """
+    # Make a single Fortran ordered copy, which is centered in place and handed to LAPACK without further copies.
+    # values is often the transpose of a C ordered matrix, so this is a straight copy rather than a reshuffle.
+    X = numpy.array(values, dtype=dtype, order='F')
+    X -= X.mean(axis=0, dtype=numpy.float64).astype(dtype)
+    totalVariance = float(numpy.linalg.norm(X))**2 / (X.shape[0]-1)  # sum of variance of all genes, without squaring a copy of X
+    maxComponents = min(X.shape)
+    nComponents = min(initialComponents, maxComponents)
+    while True:
+        # The full svd is only ever the last one computed (loop ends after it), so X can be overwritten there
+        U, s, Vt = svd(X, nComponents, exact=exact, overwrite=True)
+        s = s.astype(numpy.float64)
+        explainedVariance = s**2 / (X.shape[0]-1)
+        explainedVarianceRatio = explainedVariance / totalVariance
+        cumulativeRatio = numpy.cumsum(explainedVarianceRatio)
+        if cumulativeRatio[-1]>=varianceCutoff or len(s)>=maxComponents: break
+        nComponents = min(2*nComponents, maxComponents)
+
+    # Select the smallest number of components which reach varianceCutoff
+    # (cumulativeRatio is non-decreasing, so a binary search finds the first component reaching it)
+    n = min(int(numpy.searchsorted(cumulativeRatio, varianceCutoff))+1, len(s))
+    attributes = pandas.DataFrame({"explained_variance_":explainedVariance[:n],
+                                   "explained_variance_ratio_":explainedVarianceRatio[:n],
+                                   "singular_values_":s[:n]})
+    return U[:,:n].astype(numpy.float64) * s[:n], attributes
+
+def sortedEntries(directory):
+    """Return os.DirEntry objects of directory sorted by name. Entries carry their full path and file type,
+    so callers don't need to chdir into directory or stat each entry again.
+    """
+    with os.scandir(directory) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+def readRawMatrix(filepath):
+    """Return the raw expression matrix at filepath as a data frame of float32 values. If pcaCacheFilepath is set,
+    values are read from (or saved to) a .npy file there, with index and columns in a json file alongside it.
+    The cache is refreshed when the tsv file's modified time changes.
+    """
+    if not pcaCacheFilepath:
+        return utilities.readExpressionTsv(filepath).astype(numpy.float32)
+
+    name = os.path.join(pcaCacheFilepath, os.path.basename(filepath).replace('.raw.tsv', '.raw.f32'))
+    modifiedTime = os.path.getmtime(filepath)
+    if os.path.exists(name + '.npy') and os.path.exists(name + '.json'):
+        with open(name + '.json') as file:
+            labels = json.load(file)
+        if labels['modifiedTime']==modifiedTime:
+            return pandas.DataFrame(numpy.load(name + '.npy', mmap_mode='r'), index=labels['index'], columns=labels['columns'])
+
+    df = utilities.readExpressionTsv(filepath).astype(numpy.float32)
+    numpy.save(name + '.npy', df.to_numpy())
+    with open(name + '.json', 'w') as file:
+        json.dump({'modifiedTime':modifiedTime, 'index':df.index.tolist(), 'columns':df.columns.tolist()}, file)
+    return df
+
+def minMax(df):
+    """Return (min, max) of all values in df ignoring NaN, using numpy reductions on the underlying array
+    rather than pandas' per column df.min().min().
+    """
+    values = df.to_numpy()
+    return numpy.nanmin(values), numpy.nanmax(values)
+
+def writePCAFiles(df, directory, datasetId):
+    """Run pca on expression matrix df (genes x samples) and write the pca and pca_attributes files into directory.
+    """
+    coords, attributes = pca(df.values.T)
+    pandas.DataFrame(coords, index=df.columns).to_csv(os.path.join(directory, "%s.pca.tsv" % datasetId), sep="\t")
+    attributes.to_csv(os.path.join(directory, "%s.pca_attributes.tsv" % datasetId), sep="\t")
 
 def createPCAFiles(datasetId):
     """Given datasetId, create the pca files and place them where they should go.
     """
-    os.chdir(expressionFilepath)
-    df = pandas.read_csv(os.path.join(datasetId, "%s.raw.tsv" % datasetId), sep="\t", index_col=0)
-    min = df.min().min()
-    print(datasetId, df.shape, min, df.max().max(), min==-numpy.Inf)
-    if min==-numpy.Inf:  # assume this was logged without adding 1, so reverse the log and +1 log again
+    directory = os.path.join(expressionFilepath, datasetId)
+    df = readRawMatrix(os.path.join(directory, "%s.raw.tsv" % datasetId))
+    minValue, maxValue = minMax(df)
+    print(datasetId, df.shape, minValue, maxValue, minValue==-numpy.Inf)
+    # missing values are filled with the min after any log transform, so min is only found again if values changed
+    if minValue==-numpy.Inf:  # assume this was logged without adding 1, so reverse the log and +1 log again
         df = numpy.log2(numpy.power(2, df)+1)
-    elif df.max().max()>100: # log this first
+        minValue = minMax(df)[0]
+    elif maxValue>100: # log this first
         df = numpy.log2(df+1)
-    min = df.min().min()
-    df = df.fillna(min)
-
-    # Auto select components using this. From docs (https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html):
-    # If 0 < n_components < 1 and svd_solver == 'full', select the number of components such that the
-    # amount of variance that needs to be explained is greater than the percentage specified by n_components.
-    pca = PCA(n_components=0.99, svd_solver='full')
-    coords = pca.fit_transform(df.values.T)
-    pandas.DataFrame(coords, index=df.columns).to_csv(os.path.join(datasetId, "%s.pca.tsv" % datasetId), sep="\t")
-    pandas.DataFrame({"explained_variance_":pca.explained_variance_,
-                      "explained_variance_ratio_":pca.explained_variance_ratio_,
-                      "singular_values_":pca.singular_values_}).to_csv(os.path.join(datasetId, "%s.pca_attributes.tsv" % datasetId), sep="\t")
-
-def createPcaCoordinates():
-    os.chdir(expressionFilepath)
-    for dirname in sorted(os.listdir(expressionFilepath)):
-        if os.path.isfile(dirname) or "_" in dirname or \
-            os.path.exists(os.path.join(dirname, "%s.pca.tsv" % dirname)) or dirname in datasetsToSkip: 
-        #if os.path.isfile(dirname) or "_" in dirname: 
+        minValue = minMax(df)[0]
+    df = df.fillna(minValue)
+
+    # Auto select components to explain 99% of variance
+    writePCAFiles(df, directory, datasetId)
+
+def _initWorker():
+    """Limit each worker process to single threaded BLAS, so that workers don't oversubscribe cores.
+    Setting OPENBLAS_NUM_THREADS etc here would be too late, as numpy has already loaded BLAS when the worker is forked.
+    """
+    from threadpoolctl import threadpool_limits
+    global _threadpoolLimits
+    _threadpoolLimits = threadpool_limits(limits=1)
+
+def defaultProcessCount(filepaths, memoryFactor=4):
+    """Return the number of worker processes to use for pca of the expression files in filepaths, limited by number of cpus
+    and by available memory. Each worker holds a whole matrix (parsed values plus a float32 copy and svd workspace),
+    so allow memoryFactor times the size of the largest file per worker. Files which don't exist are ignored.
+    """
+    sizes = []
+    for filepath in filepaths:
+        try:
+            sizes.append(os.path.getsize(filepath))
+        except OSError:
+            continue
+    if len(sizes)==0: return 1
+    availableMemory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    memoryPerProcess = memoryFactor * max(1, max(sizes))
+    return max(1, min(os.cpu_count(), len(filepaths), availableMemory // memoryPerProcess))
+
+def createPcaCoordinates(processes=None):
+    """Create pca files for all datasets which don't have them yet, running one dataset per process
+    (defaults to defaultProcessCount). Datasets which fail are reported at the end.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+    worklist = []
+    for entry in sortedEntries(expressionFilepath):
+        dirname = entry.name
+        # cheap name checks first, so that the pca file is only stat'ed for candidate dataset directories
+        if "_" in dirname or dirname in datasetsToSkip or entry.is_file() or \
+            os.path.exists(os.path.join(entry.path, "%s.pca.tsv" % dirname)): 
+        #if entry.is_file() or "_" in dirname: 
             continue  # ignore files or actual directory (use symlink) or if pca file already exists
-        createPCAFiles(dirname)
+        worklist.append(dirname)
+
+    # Datasets without a raw file are reported as failed at the end, rather than stopping the whole run
+    failed = {}
+    for datasetId in worklist:
+        if not os.path.exists(os.path.join(expressionFilepath, datasetId, "%s.raw.tsv" % datasetId)):
+            failed[datasetId] = "raw.tsv file not found"
+    worklist = [datasetId for datasetId in worklist if datasetId not in failed]
+
+    if processes is None:
+        processes = defaultProcessCount([os.path.join(expressionFilepath, datasetId, "%s.raw.tsv" % datasetId) for datasetId in worklist])
+
+    # Unlike multiprocessing.Pool, ProcessPoolExecutor raises BrokenProcessPool if a worker is killed (eg. by a
+    # segmentation fault, as seen for datasetsToSkip), rather than waiting forever for its result.
+    with ProcessPoolExecutor(max_workers=processes, initializer=_initWorker) as executor:
+        futures = dict((executor.submit(createPCAFiles, datasetId), datasetId) for datasetId in worklist)
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except BrokenProcessPool as e:  # all unfinished datasets fail with this once a worker has died
+                failed[futures[future]] = "worker process died (%s)" % e
+            except Exception as e:
+                failed[futures[future]] = repr(e)
+                print("Failed", futures[future], repr(e))
+
+    if failed:
+        print("Failed to create pca files for %s datasets:" % len(failed))
+        for datasetId in sorted(failed):
+            print(datasetId, failed[datasetId])
 
 def copyDatasetsToSkip():
     """Copy the files for datasets to skip to gadi so that they can be processed there.
     We'll just copy the files to a temporary directory so that 
     """
-    destination = "pca_files_todo"  # subdirectory of expressionFilepath
-    os.chdir(expressionFilepath)
-    for dirname in sorted(os.listdir(expressionFilepath)):
-        if os.path.isfile(dirname) or "_" in dirname or dirname not in datasetsToSkip:
+    destination = os.path.join(expressionFilepath, "pca_files_todo")
+    for entry in sortedEntries(expressionFilepath):
+        dirname = entry.name
+        if entry.is_file() or "_" in dirname or dirname not in datasetsToSkip:
             continue  # ignore files or actual directory (use symlink) or if dataset not in datasetsToSkip
-        shutil.copyfile(os.path.join(dirname, "%s.raw.tsv" % dirname), os.path.join(destination, "%s.raw.tsv" % dirname))
+        source, target = os.path.join(entry.path, "%s.raw.tsv" % dirname), os.path.join(destination, "%s.raw.tsv" % dirname)
+        if os.path.exists(target):  # skip files already copied by an earlier run (copy2 keeps the modified time)
+            sourceStat, targetStat = os.stat(source), os.stat(target)
+            if sourceStat.st_size==targetStat.st_size and sourceStat.st_mtime==targetStat.st_mtime: continue
+        shutil.copy2(source, target)
 
 def movePCAFiles():
     """2021-03-02. Move the pca files which were done in gadi to where they're supposed to go.
     """
-    os.chdir("/mnt/stemformatics-data/received/pca_files_todo")
-    for filename in sorted(os.listdir()):
-        datasetId = filename.split(".")[0]
-        shutil.move(filename, os.path.join(expressionFilepath, "%s/" % datasetId))
+    for entry in sortedEntries("/mnt/stemformatics-data/received/pca_files_todo"):
+        datasetId = entry.name.split(".")[0]
+        shutil.move(entry.path, os.path.join(expressionFilepath, "%s/" % datasetId))
 
 def addMorePCAFiles():
     """2021-03-11. Create more pca files for some datasets we found.
     """
     datasetIds = ['6003', '6530']
-    os.chdir(expressionFilepath)
     for datasetId in datasetIds:
-        fileToUse = os.path.join(datasetId, "%s.raw.tsv" % datasetId) # apply PCA to this file
-        df = pandas.read_csv(fileToUse, sep="\t", index_col=0)
-        print(datasetId, df.shape, df.max().max())
-        if df.max().max()>100: # log this first
+        directory = os.path.join(expressionFilepath, datasetId)
+        fileToUse = os.path.join(directory, "%s.raw.tsv" % datasetId) # apply PCA to this file
+        df = readRawMatrix(fileToUse)
+        maxValue = minMax(df)[1]
+        print(datasetId, df.shape, maxValue)
+        if maxValue>100: # log this first
             df = numpy.log2(df+1)
 
-        pca = PCA(n_components=0.99, svd_solver='full')
-        coords = pca.fit_transform(df.values.T)
-        pandas.DataFrame(coords, index=df.columns).to_csv(os.path.join(datasetId, "%s.pca.tsv" % datasetId), sep="\t")
-        pandas.DataFrame({"explained_variance_":pca.explained_variance_,
-                          "explained_variance_ratio_":pca.explained_variance_ratio_,
-                          "singular_values_":pca.singular_values_}).to_csv(os.path.join(datasetId, "%s.pca_attributes.tsv" % datasetId), sep="\t")
+        writePCAFiles(df, directory, datasetId)
 
 def fixPCAFiles():
     """2021-04-04. We first created PCA files using raw data for RNASeq, but we should have used cpm values. So re-do these.
     """
-    os.chdir(expressionFilepath)
     # These are dc atlas datasets where cpm has already been used to generate the pca, so can ignore them.
     datasetsToIgnore = ['4135_1.0', '3082_1.0', '8144_1.0', '3120_1.0', '9747_1.0', '8507_1.0', '2494_1.0', '1611_1.0', '9002_1.0', '3559_1.0', '2865_1.0',
                         '6309_1.0']
-    for dirname in sorted(os.listdir()):
-        if os.path.isfile(dirname) or "_" not in dirname or dirname in datasetsToIgnore: continue  # ignore files or symlinks
+    for entry in sortedEntries(expressionFilepath):
+        dirname = entry.name
+        if entry.is_file() or "_" not in dirname or dirname in datasetsToIgnore: continue  # ignore files or symlinks
         datasetId = dirname.split("_")[0]
         df = None
         try:
@@ -115,25 +283,38 @@ def fixPCAFiles():
             if ds.metadata()['platform_type']=='RNASeq':
                 df = ds.expressionMatrix(key='cpm') # apply PCA to this file
         except datasets.DatasetIdNotFoundError:  # dataset not in metadata - we can still perform pca though
-            df = pandas.read_csv(os.path.join(dirname, "%s.raw.tsv" % datasetId), sep="\t", index_col=0)
-            if df.min().min()>0: df = None  # assume microarray if there are no zeros
+            df = readRawMatrix(os.path.join(entry.path, "%s.raw.tsv" % datasetId))
+            if minMax(df)[0]>0: df = None  # assume microarray if there are no zeros
 
         if df is not None:
-            print("Working on", dirname, df.shape, df.max().max())
-            if df.min().min()>=0:
+            minValue, maxValue = minMax(df)
+            print("Working on", dirname, df.shape, maxValue)
+            if minValue>=0:
                 df = numpy.log2(df+1)
 
-            # Auto select components using this. From docs (https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html):
-            # If 0 < n_components < 1 and svd_solver == 'full', select the number of components such that the
-            # amount of variance that needs to be explained is greater than the percentage specified by n_components.
-            pca = PCA(n_components=0.99, svd_solver='full')
-            coords = pca.fit_transform(df.values.T)
-            pandas.DataFrame(coords, index=df.columns).to_csv(os.path.join(dirname, "%s.pca.tsv" % datasetId), sep="\t")
-            pandas.DataFrame({"explained_variance_":pca.explained_variance_,
-                              "explained_variance_ratio_":pca.explained_variance_ratio_,
-                              "singular_values_":pca.singular_values_}).to_csv(os.path.join(dirname, "%s.pca_attributes.tsv" % datasetId), sep="\t")
+            # Auto select components to explain 99% of variance
+            writePCAFiles(df, entry.path, datasetId)
             print("Done", dirname)
 
+# ----------------------------------------------------------
+# tests: eg. $nosetests -s <filename>:ClassName.func_name
+# ----------------------------------------------------------
+def test_pca():
+    # pca should match sklearn's full svd PCA on each svd path: gram matrix for samples x genes, randomized svd
+    # (with initialComponents small enough to double at least once), and exact
+    from sklearn.decomposition import PCA
+    random = numpy.random.RandomState(0)
+    for (nSamples, nGenes), kwargs in [((20,500), {}), ((300,200), {'initialComponents':2}), ((300,200), {'exact':True})]:
+        # a few components of distinct size plus noise, so that components are well defined
+        signal = random.normal(size=(nSamples,6)) * [10,8,6,4,3,2]
+        values = signal @ random.normal(size=(6,nGenes)) + 0.1*random.normal(size=(nSamples,nGenes)) + 5
+        coords, attributes = pca(values, **kwargs)
+        model = PCA(n_components=0.99, svd_solver='full')
+        expected = model.fit_transform(values)
+        assert coords.shape==expected.shape
+        assert numpy.allclose(numpy.abs(coords), numpy.abs(expected), rtol=1e-3, atol=1e-3*numpy.abs(expected).max())
+        assert numpy.allclose(attributes['explained_variance_ratio_'], model.explained_variance_ratio_, rtol=1e-3)
+
 if __name__=="__main__":
     #createPcaCoordinates()
     #copyDatasetsToSkip()
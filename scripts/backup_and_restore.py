@@ -7,40 +7,83 @@ In the first example, a tsv file is created from dataportal.datasets collection,
 Since this will delete the existing collection first, you have to confirm this if the collection exits. 
 """
 
-import os, sys, pandas
+import os, sys, io, pandas, json, ast, csv, contextlib
 
 sys.path.append(os.path.join(sys.path[0]))
 from models import utilities, datasets
 
+@contextlib.contextmanager
+def openBackupFile(filepath):
+    """Open filepath for writing a backup as utf-8 text (like to_csv), whatever the locale is. "-" means stdout,
+    which is left open afterwards.
+    """
+    if filepath!="-":
+        with open(filepath, "w", newline="", encoding="utf-8") as file:
+            yield file
+    else:
+        file = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", newline="")
+        try:
+            yield file
+        finally:
+            file.detach()  # flushes, without closing sys.stdout
+
 def backupCollectionToCSV(database, collection, filepath):
     """Make a backup of a collection in database to a tsv file at filepath. Example:
     backupCollectionToSCV("dataportal", "samples", "samples_20210102.tsv")
+    Use filepath="-" to write to stdout instead, so the backup can be piped (eg. over ssh by scripts.migrate).
     """
     coll = utilities.mongoClient()[database][collection]
-    df = pandas.DataFrame(coll.find({},{"_id":0}))
-    df.to_csv(filepath, sep="\t", index=False)
+    # Documents are streamed to the file rather than loaded into a DataFrame first, so memory use doesn't grow with
+    # the collection. The first pass only collects field names (in order of appearance) to use as columns.
+    columns = {}
+    for document in coll.find({},{"_id":0}).batch_size(5000):
+        columns.update(dict.fromkeys(document))
+
+    with openBackupFile(filepath) as file:
+        writer = csv.DictWriter(file, fieldnames=list(columns), delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        for document in coll.find({},{"_id":0}).batch_size(5000):
+            # Write lists as json rather than python repr, so they can be parsed quickly on restore. Values json can't
+            # encode (such as datetime or ObjectId) are written as strings, as str() of the list used to do.
+            writer.writerow({key:json.dumps(value, default=str) if isinstance(value, list) else value for key,value in document.items()})
+
+def parseList(item):
+    """Parse a list written to a backup file. Newer backups are json, but older ones used python repr (single quotes),
+    so fall back to ast.literal_eval for these. Values which aren't strings (such as NaN) are returned as is.
+    """
+    if not isinstance(item, str): return item
+    try:
+        return json.loads(item)
+    except ValueError:
+        return ast.literal_eval(item)
 
-def createCollectionFromCSV(database, collection, filepath):
+def createCollectionFromCSV(database, collection, filepath, batchSize=10000, confirm=True):
     """Create a collection in database, given tsv file in filepath. Example:
     createCollectionFromCSV("dataportal", "samples", "samples_20210102.tsv").
-    If collection already exists, you'll have to confirm that you want to delete all records in it first.
+    filepath may also be an open file object, such as a remote file opened over sftp.
+    Records are inserted batchSize at a time.
+    If collection already exists, you'll have to confirm that you want to delete all records in it first
+    (unless confirm=False, for non-interactive use).
     """
     coll = utilities.mongoClient()[database][collection]
     df = pandas.read_csv(filepath, sep="\t")
 
     # For any column which is a list, parse it, otherwise it will go into mongo as a string
-    import ast
     listColumns = ['projects']  # all columns where list is expected
     for column in listColumns:
         if column in df.columns:
-            df[column] = [ast.literal_eval(item) for item in df[column]]
+            df[column] = [parseList(item) for item in df[column]]
 
-    if coll.count_documents({})>0:
+    if confirm and coll.count_documents({})>0:
         confirm = input("This collection contains documents. Are you sure you want to delete all before inserting new documents? (y/[n])\n")
         if confirm!="y": return
 
     coll.drop()
-    coll.insert_many(df.to_dict("records"))
+    # Insert in batches so only one batch of records is held as dicts at a time, and unordered so the server
+    # doesn't have to insert them one after another. The collection was just dropped, so the only index to maintain
+    # during inserts is _id - the text index is created afterwards.
+    for i in range(0, len(df), batchSize):
+        coll.insert_many(df.iloc[i:i+batchSize].to_dict("records"), ordered=False)
     createTextIndex(database, collection)
 
 def createTextIndex(database, collection):
@@ -6,10 +6,27 @@ Examples of how to run this script (ensure you're in the application directory):
 """
 
 import os, sys, pandas, re, argparse
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.join(sys.path[0]))
 from models import utilities, datasets, atlases
 
+datasetIdPattern = re.compile(r"^\d{4}")  # leading dataset id of expression directory names, eg. "1000" or "1000_1.0"
+
+def sampleIdsMismatch(datasetId):
+    """Return a message if sample ids of datasetId in metadata and expression file don't match, otherwise None.
+    """
+    ds = datasets.Dataset(datasetId)
+    sampleIdsFromMetadata = set(ds.samples().index)
+    try:
+        # Sample ids are in the header line of the raw tsv file (after the index column), so only read this line
+        with open(ds.expressionFilePath(key='raw')) as file:
+            sampleIdsFromExpression = set(file.readline().rstrip('\n').split('\t')[1:])
+        if sampleIdsFromMetadata!=sampleIdsFromExpression:
+            return "Non-matching sample ids for dataset %s (%s)" % (datasetId, ds.samples()['organism'].unique())
+    except FileNotFoundError:
+        return "Raw expression file not found for dataset %s (%s)" % (datasetId, ds.samples()['organism'].unique())
+
 def checkMissingData(publicDatasetsOnly=False, atlasDatasetsOnly=False, checkSampleIds=False):
     """Function to check for inconsistencies, where dataset metadata may have datasets with no corresponding
     sample table, for example.
@@ -29,10 +46,11 @@ def checkMissingData(publicDatasetsOnly=False, atlasDatasetsOnly=False, checkSam
     datasetIdsFromMetadata = set([item["dataset_id"] for item in database["datasets"].find(option)])
     datasetIdsFromSamples = set([item["dataset_id"] for item in database["samples"].find({})])
     datasetIdsFromExpression = set()
-    for item in os.listdir(os.environ["EXPRESSION_FILEPATH"]):
-        match = re.findall("^\d{4}", item)
-        if len(match)>0 and os.path.exists(os.path.join(os.environ['EXPRESSION_FILEPATH'], match[0], '%s.raw.tsv' % match[0])): 
-            datasetIdsFromExpression.add(int(match[0]))
+    with os.scandir(os.environ["EXPRESSION_FILEPATH"]) as entries:
+        for entry in entries:
+            match = datasetIdPattern.match(entry.name)
+            if match and os.path.exists(os.path.join(os.environ['EXPRESSION_FILEPATH'], match.group(), '%s.raw.tsv' % match.group())): 
+                datasetIdsFromExpression.add(int(match.group()))
     datasetIdsFromAtlasFiles = set()
     for atlasType in atlases.Atlas.all_atlas_types:
         datasetIdsFromAtlasFiles =  datasetIdsFromAtlasFiles.union(set(atlases.Atlas(atlasType).datasetIds()))
@@ -50,16 +68,11 @@ def checkMissingData(publicDatasetsOnly=False, atlasDatasetsOnly=False, checkSam
     print("Dataset ids from atlas files missing from metadata", len(diff3), sorted(diff3))
 
     if checkSampleIds:    # Check for consistency between sample ids - this takes longer since we need to open each expression file
+        # Each dataset is checked in a thread, since most of the time is spent waiting on file reads and mongo
         print("\n")
-        for datasetId in sorted(datasetIdsFromMetadata):
-            ds = datasets.Dataset(datasetId)
-            sampleIdsFromMetadata = set(ds.samples().index)
-            try:
-                sampleIdsFromExpression = set(ds.expressionMatrix().columns)
-                if sampleIdsFromMetadata!=sampleIdsFromExpression:
-                    print("Non-matching sample ids for dataset %s (%s)" % (datasetId, ds.samples()['organism'].unique()))
-            except FileNotFoundError:
-                print("Raw expression file not found for dataset %s (%s)" % (datasetId, ds.samples()['organism'].unique()))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for message in executor.map(sampleIdsMismatch, sorted(datasetIdsFromMetadata)):
+                if message: print(message)
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
@@ -11,7 +11,7 @@ It uses probe id to gene id mapping file which comes from psql dump of the stemf
 more specifically stemformatics.feature_mappings table.
 """
 
-import os, sys, pandas, argparse
+import os, sys, argparse
 
 # append current directoy to path so modules can be imported from models
 sys.path.append(os.path.join(sys.path[0]))
@@ -50,24 +50,15 @@ def createFile(datasetId, report_only=False):
         # 39697
         # (60366, 2) 40820
 
-    # Subset mapping using probes only found in df
-    # then create a dictionary of probe ids keyed on gene id
-    probeIdsFromGeneIds = {}
+    # Subset mapping using probes only found in df, then line up each probe row with its gene id
+    # so that all matching probe rows can be aggregated per gene using max in one pass.
+    # (merge keeps every row of df for a probe id which appears more than once)
     mapping = mapping[mapping['probeId'].isin(df.index)]
-    for index,row in mapping.iterrows():
-        probeId = row['probeId']
-        geneId = row['geneId']
-        if geneId not in probeIdsFromGeneIds:
-            probeIdsFromGeneIds[geneId] = set()
-        probeIdsFromGeneIds[geneId].add(probeId)
-    
-    # Each key of the dictionary will form a row of new dataframe
-    # with all matching probe rows aggregated using max.
-    genes = []
-    data = []
-    for geneId,probeIds in probeIdsFromGeneIds.items():
-        data.append(df.loc[list(probeIds)].max().tolist())
-        genes.append(geneId)
+    joined = mapping[['probeId','geneId']].merge(df, left_on='probeId', right_index=True)
+    data = joined.drop(columns='probeId').groupby('geneId', sort=False).max()
+    # keep genes in the order they first appear in the mapping, since groupby order follows the merged rows
+    data = data.reindex(mapping['geneId'].drop_duplicates())
+    data.index.name = None
 
     if len(data)<0.5*len(df):
         print("Less than 50% of probes recovered through mapping. Stopping.")
@@ -75,67 +66,8 @@ def createFile(datasetId, report_only=False):
 
     # write to file
     print(len(df), len(data))
-    df = pandas.DataFrame(data, index=genes, columns=df.columns)
-    df.to_csv(ds.expressionFilePath(key='genes'), sep='\t')
-    df.to_hdf(ds.expressionFilePath(key='genes', hdf5=True), 'genes')
-
-def createFileOld(datasetId, report_only=False):
-    ds = datasets.Dataset(datasetId)
-    if ds.metadata()['platform_type']!='Microarray':
-        print("Not microarray dataset")
-        return
-
-    # Read raw expression matrix
-    df = ds.expressionMatrix()
-
-    # Read gene id probe id mapping
-    mapping = pandas.read_csv('/mnt/stemformatics-data/received/www1/feature_mappings.tsv', sep='\t', header=None)
-    mapping.columns = ['db_id','mapping_id','from_type','from_id','to_type','to_id']
-    
-    if report_only:
-        print(mapping.head())
-        print(df.shape, len(set(df.index)), mapping.shape)
-        print(len(set(df.index).intersection(set(mapping['from_id']))))
-        print(len(set(df.index).intersection(set(mapping['to_id']))))
-        mapping = mapping[mapping['to_id'].isin(df.index)]
-        print(mapping.shape, len(set(mapping['from_id'])))
-        print(mapping.groupby('db_id').size())
-        return
-    #
-    #     db_id  mapping_id from_type             from_id to_type                      to_id
-    # 0     56         121      Gene    ENSG000001154151   Probe            ENSG00000115415
-    # 1     46         113      Gene  ENSMUSG00000056912   Probe  chr10:100056156-100056207
-    # 2     46         113      Gene  ENSMUSG00000044921   Probe  chr10:101974535-101974639
-    # 3     46         113      Gene  ENSMUSG00000019892   Probe  chr10:102698896-102699016
-    # 4     46         113      Gene  ENSMUSG00000019894   Probe  chr10:102830118-102830211
-    # (46693, 50) 46693 (4136182, 6)
-    # 0
-    # 28579
-    # (194758, 6) 28108
-    # db_id
-    # 59    194758
-
-    # Subset mapping using probes only found in df
-    # then create a dictionary of probe ids keyed on gene id
-    probeIdsFromGeneIds = {}
-    mapping = mapping[mapping['to_id'].isin(df.index)]
-    for index,row in mapping.iterrows():
-        probeId = row['to_id']
-        geneId = row['from_id']
-        if geneId not in probeIdsFromGeneIds:
-            probeIdsFromGeneIds[geneId] = set()
-        probeIdsFromGeneIds[geneId].add(probeId)
-    
-    # Each key of the dictionary will form a row of new dataframe
-    # with all matching probe rows aggregated using max.
-    genes = []
-    data = []
-    for geneId,probeIds in probeIdsFromGeneIds.items():
-        data.append(df.loc[list(probeIds)].max().tolist())
-        genes.append(geneId)
-
-    # write to file
-    pandas.DataFrame(data, index=genes, columns=df.columns).to_csv(ds.expressionFilePath(key='genes'), sep='\t')
+    data.to_csv(ds.expressionFilePath(key='genes'), sep='\t')
+    data.to_hdf(ds.expressionFilePath(key='genes', hdf5=True), 'genes')
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
@@ -17,10 +17,9 @@ from models import datasets
 def createH5GenesFile(datasetId):
     """Create .h5 file of genes, which is used to access gene expression faster than text files.
     """
-    os.chdir(os.getenv('EXPRESSION_FILEPATH'))
     ds = datasets.Dataset(datasetId)
     df = pandas.read_csv(ds.expressionFilePath(key="genes"), sep="\t", index_col=0)
-    dirname = "%s_%s" % (datasetId, ds.metadata()['version'])
+    dirname = os.path.join(os.getenv('EXPRESSION_FILEPATH'), "%s_%s" % (datasetId, ds.metadata()['version']))
     store = pandas.HDFStore(f"{dirname}/{datasetId}.genes.h5")
     store["genes"] = df
     store.close()
@@ -49,24 +48,29 @@ def importExpressionData(datasetId):
         return
     
     # Make directory locally
-    os.chdir(os.getenv('EXPRESSION_FILEPATH'))
     dirname = "%s_%s" % (datasetId, ds.metadata()['version'])
-    if not os.path.exists(dirname):
-        os.mkdir(dirname)
-    if not os.path.exists(str(datasetId)):
-        os.symlink(dirname, str(datasetId), target_is_directory=True)
+    localDirectory = os.path.join(os.getenv('EXPRESSION_FILEPATH'), dirname)
+    if not os.path.exists(localDirectory):
+        os.mkdir(localDirectory)
+    symlink = os.path.join(os.getenv('EXPRESSION_FILEPATH'), str(datasetId))
+    if not os.path.exists(symlink):
+        os.symlink(dirname, symlink, target_is_directory=True)  # target is relative to the symlink's directory
 
     # Copy relevant files from data-source
     ssh = SSHClient()
     ssh.load_system_host_keys()
     ssh.connect('data-source.stemformatics.org')
     scp = SCPClient(ssh.get_transport())
-    scp.get('/mnt/data/pending/%s/qc/pcas/%s.pca.tsv' % (dirname, datasetId), local_path=dirname)
-    scp.get('/mnt/data/pending/%s/qc/pcas/%s.pca_attributes.tsv' % (dirname, datasetId), local_path=dirname)
+    remotePaths = ['/mnt/data/pending/%s/qc/pcas/%s.pca.tsv' % (dirname, datasetId),
+                   '/mnt/data/pending/%s/qc/pcas/%s.pca_attributes.tsv' % (dirname, datasetId)]
     if ds.metadata()['platform_type']=='RNASeq':
-        scp.get('/mnt/data/pending/%s/feature_counts/%s.raw.tsv' % (dirname, datasetId), local_path=dirname)
+        remotePaths.append('/mnt/data/pending/%s/feature_counts/%s.raw.tsv' % (dirname, datasetId))
     else:
-        scp.get('/mnt/data/pending/%s/tables/%s.raw.tsv' % (dirname, datasetId), local_path=dirname)
+        remotePaths.append('/mnt/data/pending/%s/tables/%s.raw.tsv' % (dirname, datasetId))
+    # Fetch all files in one scp session rather than starting a new remote scp for each file
+    scp.get(remotePaths, local_path=localDirectory)
+    scp.close()
+    ssh.close()
 
     createH5GenesFile(datasetId)
 
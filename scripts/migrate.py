@@ -5,122 +5,219 @@ Script to migrate code and data from one server to another. Use it like this on
 
 It will ask for the source server, which will be used to copy data from, if that is required.
 For updating code, it will use git pull, which will ignore the source server.
+
+Steps can also be given as options, in which case nothing is asked and the steps run at the same time, eg.
+    (s4m-api) [ec2-user@api-test s4m-api]$ python -m scripts.migrate --source dev --rsync expression atlas --copy datasets samples
 """
 
-import os, subprocess, scp
+import os, io, subprocess, asyncio, signal, time, argparse, socket
 from paramiko import SSHClient
-from scp import SCPClient
 from datetime import date
 
 source = None
 _ssh = None
+_sftp = None
+
+# ssh command used by rsync: the first rsync opens a master connection which later ones reuse, so they don't each
+# go through a full handshake. AES-GCM is hardware accelerated on current CPUs, so encryption doesn't limit throughput.
+_rsyncSSH = "ssh -T -c aes128-gcm@openssh.com -o Compression=no " \
+            "-o ControlMaster=auto -o ControlPath=~/.ssh/cm-%r@%h:%p -o ControlPersist=600"
 
 def _getSSH():
-    """Make a ssh connection to the source server and return the SSHClient object
+    """Make a ssh connection to the source server and return the SSHClient object.
+    The connection is reused by later calls while it's still active, otherwise a new one is made.
     """
-    global _ssh
-    if _ssh is None:
+    global _ssh, _sftp
+    if _ssh is None or _ssh.get_transport() is None or not _ssh.get_transport().is_active():
         _ssh = SSHClient()
         _ssh.load_system_host_keys()
         _ssh.connect(f'{source}.stemformatics.org')
+        transport = _ssh.get_transport()
+        transport.set_keepalive(30)  # so the connection isn't dropped while idle during long local steps
+        # Don't hold back small packets (sftp stat and exec requests are small), and use a larger ssh window for new
+        # channels so a single channel can keep more data in flight over a long round trip. Socket buffer sizes are
+        # left to the kernel, since setting them explicitly turns off Linux's buffer autotuning.
+        transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport.default_window_size = 4*1024*1024
+        _sftp = None  # any existing client belongs to the old connection
     return _ssh
 
-def rsyncFiles():
+def _getSFTP():
+    """Return SFTPClient on the ssh connection to the source server, opening it only once per connection.
+    """
+    global _sftp
+    ssh = _getSSH()
+    if _sftp is None:
+        _sftp = ssh.open_sftp()
+    return _sftp
+
+def _remoteFileExists(filepath):
+    """Return True if filepath exists on the source server. Uses stat over sftp, which doesn't start a remote shell.
+    """
+    try:
+        _getSFTP().stat(filepath)
+        return True
+    except IOError:
+        return False
+
+def _choose(options, chosen, question):
+    """Return the options to act on, in order. If chosen is a list (options given on the command line), these are used,
+    otherwise the user is asked question (formatted with the option) for each option.
+    """
+    if chosen is not None:
+        return [option for option in options if option in chosen]
+    return [option for option in options if input(question.format(option) + " [N]/y ")=='y']
+
+async def rsyncFiles(chosen=None):
     """Expression files are copied from source server using rsync. 
     Example rsync usage on command line (note trailing / on the source directory!):
     rsync -avz dev.stemformatics.org:/mnt/stemformatics-data/atlas/ /mnt/stemformatics-data/atlas
     """
-    answer = input("rsync expression files? [N]/y ")
-    if (answer=='y'):
-        filepath = os.environ['EXPRESSION_FILEPATH']
-        command = ["rsync","-avz",f"{source}.stemformatics.org:{filepath}/", filepath]
+    # Ask about both first, then run the rsyncs at the same time, so the link isn't idle while one of them
+    # is scanning files. --whole-file skips the delta algorithm (the network is faster than checksumming here)
+    # and --partial keeps a partly transferred file if the transfer is interrupted, rather than deleting it.
+    processes = []
+    for key in _choose(['expression', 'atlas'], chosen, "rsync {} files?"):
+        filepath = os.environ[f"{key.upper()}_FILEPATH"]
+        # Compression is cpu bound and slower than the network between servers, so only use it if asked for
+        # (eg. RSYNC_COMPRESS=1 over a slow link - tsv files compress well)
+        command = ["rsync","-avz" if os.environ.get('RSYNC_COMPRESS')=='1' else "-av","--whole-file","--partial","-e",_rsyncSSH,f"{source}.stemformatics.org:{filepath}/", filepath]
         print(subprocess.list2cmdline(command))
-        process = subprocess.run(command)
+        processes.append(await asyncio.create_subprocess_exec(*command))
 
-    answer = input("rsync atlas files? [N]/y ")
-    if (answer=='y'):
-        filepath = os.environ['ATLAS_FILEPATH']
-        command = ["rsync","-avz",f"{source}.stemformatics.org:{filepath}/", filepath]
-        print(subprocess.list2cmdline(command)) 
-        process = subprocess.run(command)
+    await asyncio.gather(*[process.wait() for process in processes])
 
-def copyMongoData():
+def copyMongoData(chosen=None):
     """Metadata are copied from source server using dump to text then read from text.
+    If chosen is given, nothing is asked: existing backup files at source are used and local collections are replaced.
     """
-    for key in ['datasets','samples']:
-        answer = input(f"Copy {key} metadata files? [N]/y ")
-        if (answer=='y'):
-            # Make a backup of metadata at source and copy here
-            filename = f"{key}_{date.today().strftime('%Y%m%d')}"    # eg. datasets_20210902
-
-            # First check if backup file already exists
-            # Runs a bash command like this on source: test -f /mnt/stemformatics-data/expression_files/../backups/datasets_20210902 && echo 'true'
-            # which will return 'true' if the file exists
-            filepath = f"{os.environ['EXPRESSION_FILEPATH'].replace('expression_files','backups')}/{filename}.tsv"
-            command = f"test -f {filepath} && echo 'true'" 
+    # Backups are kept at source in a directory next to the expression files, eg. /mnt/stemformatics-data/backups
+    backupsFilepath = os.environ['EXPRESSION_FILEPATH'].replace('expression_files','backups')
+    today = date.today().strftime('%Y%m%d')
+    from scripts.backup_and_restore import createCollectionFromCSV
+
+    for key in _choose(['datasets','samples'], chosen, "Copy {} metadata files?"):
+        # Make a backup of metadata at source and copy here
+        filename = f"{key}_{today}"    # eg. datasets_20210902
+
+        # First check if backup file already exists at source, eg. /mnt/stemformatics-data/backups/datasets_20210902.tsv
+        filepath = f"{backupsFilepath}/{filename}.tsv"
+        createBackupFile = True
+        if _remoteFileExists(filepath):
+            if chosen is not None or input(f"File at source ({filepath}) already exists. Use this? [N]/y ")=='y':
+                createBackupFile = False
+            else:   # just quit the program and handle the existing file first manually
+                return
+
+        if createBackupFile:
+            # Stream the backup from source straight into the local restore: the remote backup writes to stdout,
+            # with tee keeping a copy of the file at source. The stream is held in memory until the remote command
+            # has succeeded, so a failed backup can't leave a partly restored collection here.
+            command = f"cd; cd s4m-api; conda activate s4m-api; set -o pipefail; " \
+                      f"python -m scripts.backup_and_restore backupCollectionToCSV dataportal {key} - | tee {filepath}"
             print(command)
-            ssh = _getSSH()
-            stdin, stdout, stderr = ssh.exec_command(command)
-            output = stdout.readlines()
-            createBackupFile = True
-            if output==['true\n']:
-                if input(f"File at source ({filepath}) already exists. Use this? [N]/y ")=='y':
-                    createBackupFile = False
-                else:   # just quit the program and handle the existing file first manually
-                    return
-
-            if createBackupFile:    # create backup
-                command = f"cd; cd s4m-api; conda activate s4m-api; python -m scripts.backup_and_restore backupCollectionToCSV dataportal {key} {filepath}"
-                print(command)
-                stdin, stdout, stderr = ssh.exec_command(command)
-
-            # scp here
-            localfile = f"{os.environ['EXPRESSION_FILEPATH'].replace('expression_files','received')}/{source}/{filename}.tsv"
-            scp = SCPClient(ssh.get_transport())
-            scp.get(filepath, local_path=localfile)
-
-            # Now run backup_and_restore locally
-            from scripts.backup_and_restore import createCollectionFromCSV
-            createCollectionFromCSV('dataportal',key,localfile)
-
-def gitPull():
-    """Code update is done through git pull (easier for public repositories)
+            stdin, stdout, stderr = _getSSH().exec_command(command)
+            data = io.BytesIO(stdout.read())
+            if stdout.channel.recv_exit_status()!=0:
+                print("Backup failed at source:", stderr.read().decode())
+                return
+            createCollectionFromCSV('dataportal',key,data,batchSize=5000,confirm=chosen is None)
+        else:
+            # Read the existing backup file straight from source rather than copying it here first.
+            # prefetch makes paramiko request the whole file ahead of reads, so the transfer overlaps parsing.
+            with _getSFTP().open(filepath, 'rb') as file:
+                file.prefetch()
+                createCollectionFromCSV('dataportal',key,file,batchSize=5000,confirm=chosen is None)
+
+async def gitPull(chosen=None):
+    """Code update is done through git pull (easier for public repositories). Both repositories are pulled at the same time.
     """
-    for key in ["s4m-api", "s4m-ui"]:
-        answer = input(f"git pull {key}? [N]/y ")
-        if (answer=='y'):
-            process = subprocess.run(f"cd; cd {key}; git pull", shell=True)
+    processes = []
+    for key in _choose(["s4m-api", "s4m-ui"], chosen, "git pull {}?"):
+        # git -C runs in the repository directory without starting a shell to cd there
+        processes.append(await asyncio.create_subprocess_exec("git", "-C", os.path.expanduser(f"~/{key}"), "pull"))
+
+    await asyncio.gather(*[process.wait() for process in processes])
 
-def restartServers():
+def _findProcess(name):
+    """Return pid of the first process owned by the current user whose command line contains name, or None.
+    Reads /proc directly rather than running and parsing ps.
+    """
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit() or int(entry.name)==os.getpid(): continue
+        try:
+            if entry.stat().st_uid!=os.getuid(): continue
+            with open(os.path.join(entry.path, 'cmdline'), 'rb') as file:
+                if name.encode() in file.read():
+                    return int(entry.name)
+        except OSError:  # process ended while we were looking
+            continue
+    return None
+
+def _stopProcess(pid, timeout=10):
+    """Send SIGTERM to pid and wait up to timeout seconds for it to exit, then send SIGKILL if it's still running.
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+        for i in range(timeout*10):
+            time.sleep(0.1)
+            os.kill(pid, 0)  # raises ProcessLookupError once the process has gone
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def restartServers(chosen=None):
     """Restart server after updates.
     """
-    answer = input(f"restart s4m-api server? [N]/y ")
-    if (answer=='y'):
-        # find pid and kill it
-        ps = subprocess.run(['ps', '-u'], stdout=subprocess.PIPE, universal_newlines=True)
-        cols = [line for line in ps.stdout.splitlines() if 'waitress-serve' in line]
-        if len(cols)>0:
-            subprocess.run(['kill', cols[0].split()[1]])
-        # restart
-        subprocess.run("nohup waitress-serve --port=5000 app:app > waitress.log 2>&1 &", shell=True)
-
-    answer = input(f"restart s4m-ui server? [N]/y ")
-    if (answer=='y'):
-        subprocess.run("cd; cd s4m-ui; source /mnt/miniconda3/bin/activate s4m-ui; npm run build; pm2 stop ecosystem.config.js; pm2 start", shell=True)
-
-def main():
-    rsyncFiles()
-    print("\n")
-    copyMongoData()
-    print("\n")
-    gitPull()
-    print("\n")
-    restartServers()
+    servers = _choose(["s4m-api", "s4m-ui"], chosen, "restart {} server?")
+    if 's4m-api' in servers:
+        # find pid and stop it
+        pid = _findProcess('waitress-serve')
+        if pid is not None:
+            _stopProcess(pid)
+        # restart in the background, in its own session so it keeps running after this terminal closes (like nohup)
+        directory = os.path.expanduser("~/s4m-api")
+        with open(os.path.join(directory, "waitress.log"), "w") as log:
+            subprocess.Popen(["waitress-serve", "--port=5000", "app:app"], cwd=directory, stdout=log, stderr=subprocess.STDOUT,
+                             start_new_session=True)
+
+    if 's4m-ui' in servers:
+        # s4m-ui conda environment only needs to be on PATH for npm and pm2, rather than activating it in a shell
+        directory = os.path.expanduser("~/s4m-ui")
+        env = dict(os.environ, PATH=f"/mnt/miniconda3/envs/s4m-ui/bin:{os.environ['PATH']}")
+        for command in [["npm", "run", "build"], ["pm2", "stop", "ecosystem.config.js"], ["pm2", "start"]]:
+            subprocess.run(command, cwd=directory, env=env)
+
+async def main(args):
+    if not any([args.rsync, args.copy, args.git_pull, args.restart]):  # interactive - ask about each step in turn
+        await rsyncFiles()
+        print("\n")
+        copyMongoData()
+        print("\n")
+        await gitPull()
+        print("\n")
+        restartServers()
+        return
+
+    # Steps were given on the command line, so run them all at the same time (copyMongoData uses blocking calls,
+    # so it runs in a thread), and restart servers once they have all finished.
+    await asyncio.gather(rsyncFiles(args.rsync or []),
+                         asyncio.get_running_loop().run_in_executor(None, copyMongoData, args.copy or []),
+                         gitPull(args.git_pull or []))
+    restartServers(args.restart or [])
 
 if __name__=="__main__":
-    source = input("Set source of migration [dev,test,prod1,prod2]: ")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", help="source of migration [dev,test,prod1,prod2]")
+    parser.add_argument("--rsync", nargs="+", choices=["expression", "atlas"], help="rsync these files from source")
+    parser.add_argument("--copy", nargs="+", choices=["datasets", "samples"], help="copy these metadata collections from source")
+    parser.add_argument("--git-pull", nargs="+", choices=["s4m-api", "s4m-ui"], help="git pull these repositories")
+    parser.add_argument("--restart", nargs="+", choices=["s4m-api", "s4m-ui"], help="restart these servers")
+    args = parser.parse_args()
+
+    source = args.source or input("Set source of migration [dev,test,prod1,prod2]: ")
     if source in ['test','dev','prod1','prod2']:
         print(f"Source set to {source}.\n")
-        main()
+        asyncio.run(main(args))
     else:
         print("Source should be either test or dev")